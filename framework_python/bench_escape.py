@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+
+##
+## HTMLエスケープの速度を、典型的なフォームや一覧ページのデータで比べる
+##
+## usage: python bench_escape.py [N]
+##
+
+import sys
+import html
+from timeit import timeit
+
+from fw38 import escape_html, h
+
+
+## フォームの入力値: 名前やメールアドレスなど、ほとんど特殊文字を含まない
+FORM_VALUES = [
+    "Alice", "alice@example.com", "Tokyo", "090-1234-5678", "2024-01-01",
+    "I'd like to book a table for 2 people.", "Tom & Jerry", "ok",
+]
+
+## 一覧ページ: 短い文字列や数値が大量に並び、repr() した値も含まれる
+LIST_VALUES = (["item-%d" % i for i in range(40)] + list(range(40))
+               + [repr({"name": "Bob", "tags": ["<b>", "x"]})] * 4)
+
+
+_TABLE = str.maketrans({'&': '&amp;', '<': '&lt;', '>': '&gt;',
+                        '"': '&quot;', "'": '&#39;'})
+
+def escape_by_translate(value):
+    return str(value).translate(_TABLE)
+
+def escape_by_stdlib(value):
+    return html.escape(str(value))
+
+
+def main(n):
+    funcs = (escape_by_stdlib, escape_by_translate, escape_html, h)
+    for title, values in (("form", FORM_VALUES), ("list", LIST_VALUES)):
+        print("## %s (%d values x %d)" % (title, len(values), n))
+        for func in funcs:
+            sec = timeit(lambda: [ func(v) for v in values ], number=n)
+            print("%-22s %8.3f sec" % (func.__name__, sec))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
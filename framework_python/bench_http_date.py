@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+
+##
+## HTTPの日時文字列を作る方法ごとの速度を比べる
+##
+## usage: python bench_http_date.py [N]
+##
+
+import sys
+import time
+from timeit import timeit
+from datetime import datetime, timezone
+
+from fw27 import http_datetime, http_timestamp, http_date_clock
+
+
+def by_strftime():
+    return datetime.now(timezone.utc).strftime('%a, %d %b %Y %H:%M:%S GMT')
+
+def by_http_datetime():
+    return http_datetime(datetime.now(timezone.utc))
+
+def by_http_timestamp():
+    return http_timestamp(time.time())
+
+def by_http_date_clock():
+    return http_date_clock.now()
+
+
+def main(n):
+    for func in (by_strftime, by_http_datetime, by_http_timestamp, by_http_date_clock):
+        sec = timeit(func, number=n)
+        print("%-20s %8.3f sec  (%6.3f usec/call)" % (func.__name__, sec, sec * 1000000 / n))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+
+##
+## フレームワークの import にかかる時間を 'python -X importtime' で比べる
+##
+## usage: python bench_import_time.py [module ...]
+##
+
+import sys
+import os
+import subprocess
+
+
+def import_time(module, repeat=5):
+    ## 各回の最小値を使う (ファイルキャッシュなどの影響を減らすため)
+    here = os.path.dirname(os.path.abspath(__file__))
+    best = None
+    for _ in range(repeat):
+        cmd = [sys.executable, "-X", "importtime", "-c", "import %s" % module]
+        p = subprocess.run(cmd, cwd=here, stderr=subprocess.PIPE,
+                           stdout=subprocess.DEVNULL, universal_newlines=True)
+        ## ex: 'import time:      1576 |      21579 | fw30'
+        for line in p.stderr.splitlines():
+            cols = line.split('|')
+            if len(cols) == 3 and cols[2].strip() == module:
+                usec = int(cols[1])
+                if best is None or usec < best:
+                    best = usec
+    return best
+
+
+def main(modules):
+    for mod in modules:
+        usec = import_time(mod)
+        print("%-10s %8.3f msec" % (mod, usec / 1000.0))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:] or ["fw30", "fw31"])
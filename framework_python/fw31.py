@@ -0,0 +1,1557 @@
+# -*- coding: utf-8 -*-
+
+##
+## subject: 起動を速くするため、モジュールと正規表現を遅延読み込みする
+##
+
+import sys
+import os
+import time
+import threading
+
+
+## 起動を速くするため、特定の処理でしか使わないモジュールは最初に使うときに import する。
+## 一度取り出した属性はインスタンス変数として保存されるので、二回目以降は速い。
+class _LazyModule(object):
+
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attr):
+        name = self.__dict__['_name']
+        __import__(name)
+        val = getattr(sys.modules[name], attr)
+        setattr(self, attr, val)
+        return val
+
+    def __repr__(self):
+        return "<lazy module %r>" % self._name
+
+re          = _LazyModule('re')
+json        = _LazyModule('json')
+hmac        = _LazyModule('hmac')
+hashlib     = _LazyModule('hashlib')
+base64      = _LazyModule('base64')
+secrets     = _LazyModule('secrets')
+random      = _LazyModule('random')
+collections = _LazyModule('collections')
+_urlparse   = _LazyModule('urllib.parse')
+_html       = _LazyModule('html')
+_datetime   = _LazyModule('datetime')
+
+
+def h(s, quote=True):
+    return _html.escape(s, quote)
+
+
+class HttpException(Exception):
+
+    ## 例外でもクッキーを返すときに使う。 ex: ['sid=...; Path=/']
+    cookies = None
+
+    def __init__(self, status, content=None, headers=None):
+        self.status  = status
+        self.content = content
+        self.headers = headers
+
+
+class Request(object):
+
+    ## 計測中のときだけ、PhaseTimer オブジェクトが設定される
+    timer = None
+
+    def __init__(self, environ):
+        self.environ = environ
+        self.method  = environ['REQUEST_METHOD']
+        self.path    = environ['PATH_INFO']
+
+    @property
+    def query_string(self):
+        return self.environ['QUERY_STRING']
+
+    @property
+    def content_type(self):
+        return self.environ.get('CONTENT_TYPE')
+
+    @property
+    def content_length(self):
+        s = self.environ.get('CONTENT_LENGTH')
+        try:
+            return int(s) if s else None
+        except:
+            msg = "<p>%r: invalid content lenght.</p>"
+            raise HttpException(400, msg % (s,))
+
+    MAX_FORM_SIZE      =   1 * 1024 * 1024  #  2MB
+    MAX_JSON_SIZE      =   1 * 1024 * 1024  #  2MB
+    MAX_MULTIPART_SIZE =  10 * 1024 * 1024  # 10MB
+
+    @property
+    def query(self):
+        if not hasattr(self, '_query'):
+            self._query = _parse_query_str(self.query_string)
+        return self._query
+
+    @property
+    def form(self):
+        if not hasattr(self, '_form'):
+            self._check_ctype("application/x-www-form-urlencoded")
+            self._form = _parse_query_str(self._read_input(self.MAX_FORM_SIZE))
+        return self._form
+
+    @property
+    def json(self):
+        if not hasattr(self, '_json'):
+            self._check_ctype("application/json")
+            self._json = json.loads(self._read_input(self.MAX_JSON_SIZE))
+        return self._json
+
+    @property
+    def multipart(self):
+        if not hasattr(self, '_multipart'):
+            self._check_ctype("multipart/form-data")
+            mp = MultiPart(self.content_type)
+            strs, files = mp.parse(self._read_input(self.MAX_MULTIPART_SIZE))
+            self._multipart = (strs, files)
+        return self._multipart
+
+    def _read_input(self, max_size):
+        if hasattr(self, '_eof'):
+            return ""
+        if self.content_length is None:
+            raise _http400("content-length required.")
+        if self.content_length > max_size:
+            raise _http400("content-length too large.")
+        input   = self.environ['wsgi.input']
+        binary  = input.read(self.content_length)
+        self._eof = True
+        unicode = binary.decode('utf-8')
+        return unicode
+
+    def _check_ctype(self, expected):
+        ctype = self.content_type or ""
+        if not ctype.startswith(expected):
+            msg = "expected content type is %r, but actual is %r."
+            raise _http400(msg % (expected, ctype))
+
+    ## クッキーはすぐには解析せず、参照されたものだけを取り出す
+    @property
+    def cookies(self):
+        if not hasattr(self, '_cookies'):
+            cookie_str = self.environ.get('HTTP_COOKIE')
+            self._cookies = LazyCookies(cookie_str)
+        return self._cookies
+
+
+def _parse_query_str(query_str):
+    d = {}
+    if not query_str:
+        return d
+    unq = _urlparse.unquote_plus
+    ss = query_str.split('&') # ex: 'x=1&y=2' -> ['x=1', 'y=2']
+    for s in ss:
+        kv = s.split('=', 1)  # ex: 'x=1' -> ['x', '1']; 'x' -> ['x']
+        if len(kv) == 2:
+            k, v = kv
+        else:
+            k = kv[0]; v = ""
+        k = unq(k); v = unq(v)
+        if k.endswith('[]'):
+            d.setdefault(k, []).append(v)
+        else:
+            d[k] = v
+    return d
+
+
+def _parse_cookie_str(cookie_str):
+    d = {}
+    if cookie_str:
+        unq = _unquote_if_needed
+        for s in cookie_str.split(';'):   # ex: 'x=1; y=2' -> ['x=1', ' y=2']
+            kv = s.strip().split('=', 1)  # ex: ' x=1' -> ['x', '1']; 'x' -> ['x']
+            k, v = kv if len(kv) == 2 else (kv[0], "")
+            d[unq(k)] = unq(v)
+    return d
+
+
+## '%' も '+' も含まなければ、unquote_plus() を呼ぶ必要はない
+def _unquote_if_needed(s):
+    if '%' in s or '+' in s:
+        return _urlparse.unquote_plus(s)
+    return s
+
+
+## 参照されたクッキーだけをデコードする、dict風のオブジェクト
+class LazyCookies(object):
+
+    def __init__(self, cookie_str):
+        self._cookie_str = cookie_str or ""
+        self._values     = {}     # ex: {'sid': 'abc123'}
+        self._parsed     = None   # result of _parse_cookie_str()
+        self._escaped    = None   # クッキー名にエスケープを含むものがあれば True
+
+    def get(self, name, default=None):
+        if self._parsed is not None:
+            return self._parsed.get(name, default)
+        d = self._values
+        if name in d:
+            return d[name]
+        val = self._find(name)
+        if val is None:
+            ## クッキー名がエンコードされている可能性があれば、全体を解析する
+            ## (値に '%' や '+' があるのはよくあることなので、名前だけを調べる)
+            if self._has_escaped_name():
+                return self._all().get(name, default)
+            return default
+        d[name] = val
+        return val
+
+    def __getitem__(self, name):
+        val = self.get(name)
+        if val is None:
+            raise KeyError(name)
+        return val
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+    def _has_escaped_name(self):
+        if self._escaped is None:
+            self._escaped = False
+            for item in self._cookie_str.split(';'):
+                key = item.partition('=')[0]
+                if '%' in key or '+' in key:
+                    self._escaped = True
+                    break
+        return self._escaped
+
+    def _find(self, name):
+        s = self._cookie_str
+        n = len(name)
+        if not n:
+            return None
+        end = len(s)
+        ## 同じ名前のクッキーは後ろのものが優先されるので、後ろから探す
+        while True:
+            i = s.rfind(name, 0, end)
+            if i < 0:
+                return None
+            end = i
+            ## 直前が ';' か先頭、直後が '=' か ';' か末尾であること
+            k = i - 1
+            while k >= 0 and s[k] in ' \t':
+                k -= 1
+            if k >= 0 and s[k] != ';':
+                continue
+            j = i + n
+            if j == len(s) or s[j] == ';':
+                return ""
+            if s[j] != '=':
+                continue
+            e = s.find(';', j)
+            val = s[j+1:e] if e >= 0 else s[j+1:]
+            return _unquote_if_needed(val.rstrip())
+
+    def _all(self):
+        if self._parsed is None:
+            self._parsed = _parse_cookie_str(self._cookie_str)
+        return self._parsed
+
+    def __iter__(self):
+        return iter(self._all())
+
+    def __len__(self):
+        return len(self._all())
+
+    def keys(self):
+        return self._all().keys()
+
+    def values(self):
+        return self._all().values()
+
+    def items(self):
+        return self._all().items()
+
+    def __eq__(self, other):
+        if isinstance(other, LazyCookies):
+            other = other._all()
+        return self._all() == other
+
+    def __repr__(self):
+        return repr(self._all())
+
+
+def _http400(msg):
+    status = "400 Bad Request"
+    content = "%s: %s" % (status, msg)
+    return HttpException(status, content)
+
+
+class MultiPart(object):
+
+    def __init__(self, content_type):
+        if not content_type:
+            raise _http400("content type required.")
+        if not content_type.startswith("multipart/form-data;"):
+            raise _http400("not a multipart.")
+        m = re.search(r'''boundary=(['"]?)([-\w]+)\1?''', content_type)
+        if not m:
+            raise _http400("boundary required.")
+        self.boundary = m.group(2)
+
+    def parse(self, string):
+        strs  = {}
+        files = {}
+        for t in self._each_entry(string):
+            name, val, filename = t
+            if not name:
+                continue
+            d = files if filename else strs
+            if filename:
+                v = (val, filename)
+                d = files
+            else:
+                v = val
+                d = strs
+            if name.endswith('[]'):
+                d.setdefault(name, []).append(v)
+            else:
+                d[name] = v
+        return strs, files
+
+    def _each_entry(self, string):
+        boundary  = self.boundary
+        separator = "\r\n--%s\r\n"   % boundary
+        preamble  =     "--%s\r\n"   % boundary
+        postamble = "\r\n--%s--\r\n" % boundary
+        arr = string.split(separator)
+        if not arr[0].startswith(preamble):
+            raise _http400("preamble unmatched.")
+        if not arr[-1].endswith(postamble):
+            raise _http400("postamble unmatched.")
+        arr[0]  = arr[0][len(preamble):]
+        arr[-1] = arr[-1][:-len(postamble)]
+        #
+        pat  = r'^Content-Disposition: *form-data(?:; *name="(.*?)")?(?:; *filename="(.*?)")?'
+        rexp = re.compile(pat, re.M | re.I)
+        for s in arr:
+            pair = s.split("\r\n\r\n", 1)
+            if len(pair) != 2:
+                raise _http400("missing header part.")
+            header, val = pair
+            m = rexp.search(header)
+            if not m:
+                raise _http400("invalid content disposition.")
+            name, filename = m.groups()
+            unq      = _urlparse.unquote_plus
+            name     = unq(name)     if name else None
+            filename = unq(filename) if filename else None
+            val      = unq(val)
+            yield name, val, filename
+
+
+class Response(object):
+
+    def __init__(self):
+        self.status  = "200 OK"
+        self.headers = {
+            'Content-Type': "text/html;charset=utf-8",
+        }
+        self._cookies = []
+
+    def header_list(self):
+        items = list(self.headers.items())
+        if 'Date' not in self.headers:
+            items.append(('Date', http_date_clock.now()))
+        if self._cookies:
+            k = 'Set-Cookie'
+            items.extend( (k, s) for s in self._cookies )
+        return items
+
+    @property
+    def content_type(self):
+        return self.headers['Content-Type']
+
+    @content_type.setter
+    def content_type(self, value):
+        self.headers['Content-Type'] = value
+
+    ## ex: self.resp.set_last_modified(os.path.getmtime(filepath))
+    def set_last_modified(self, mtime):
+        self.headers['Last-Modified'] = http_timestamp(int(mtime))
+
+    ## クッキーを追加する。名前と値は必須、それ以外は省略可。
+    ## 名前のかわりに CookieTemplate オブジェクトも指定できる。
+    def add_cookie(self, name, value,
+                   domain=None, path=None, expires=None, max_age=None,
+                   httponly=None, secure=None):
+        if isinstance(name, CookieTemplate):
+            cookie_str = name.render(value, expires)
+        else:
+            suffix = _cookie_attrs(domain, path, expires, max_age,
+                                   httponly, secure)
+            cookie_str = _quote_cookie(name) + "=" + _quote_cookie(value) + suffix
+        self._cookies.append(cookie_str)
+        return cookie_str
+
+    ## 過去の遠い日付をexpiresに設定することで、クッキーを無効化する
+    def expire_cookie(self, cookie_name,
+                      domain=None, path=None, max_age=None,
+                      httponly=None, secure=None):
+        if isinstance(cookie_name, CookieTemplate):
+            self._cookies.append(cookie_name.expired)
+            return
+        expires = _PAST_DATE
+        self.add_cookie(cookie_name, "",
+                        domain=domain, path=path, expires=expires, max_age=max_age,
+                        httponly=httponly, secure=secure)
+
+
+_PAST_DATE = 'Thu, 01 Jan 1970 00:00:00 GMT'
+
+
+## 毎回同じ属性を組み立てるのは無駄なので、属性部分をあらかじめ作っておく
+## ex:
+##   SESSION_COOKIE = CookieTemplate('sid', path='/', httponly=True)
+##   self.resp.add_cookie(SESSION_COOKIE, sid)
+class CookieTemplate(object):
+
+    def __init__(self, name,
+                 domain=None, path=None, max_age=None,
+                 httponly=None, secure=None):
+        self.name     = name
+        self._prefix  = _quote_cookie(name) + "="
+        self._suffix  = _cookie_attrs(domain, path, None, max_age,
+                                      httponly, secure)
+        ## 無効化用の文字列も作っておく (Max-Age は付けない)
+        self.expired  = self._prefix + _cookie_attrs(domain, path, _PAST_DATE,
+                                                     None, httponly, secure)
+
+    def render(self, value, expires=None):
+        s = self._prefix + _quote_cookie(value) + self._suffix
+        if expires is not None:
+            s += "; Expires=" + _expires_str(expires)
+        return s
+
+
+def _cookie_attrs(domain, path, expires, max_age, httponly, secure):
+    buf = []; add = buf.append
+    if domain  : add("; Domain=%s"  % domain)
+    if path    : add("; Path=%s"    % path)
+    if expires : add("; Expires=%s" % _expires_str(expires))
+    if max_age : add("; Max-Age=%s" % max_age)
+    if httponly: add("; HttpOnly")
+    if secure  : add("; Secure")
+    return "".join(buf)
+
+
+def _expires_str(expires):
+    ## expiresには、文字列かdate型を指定する。
+    ## なおPythonではUTCへの変換が面倒なため、datetime型はエラー
+    if isinstance(expires, str):
+        return expires
+    ## (datetime は date のサブクラスなので、先に調べること)
+    dt = _datetime
+    if isinstance(expires, dt.datetime):
+        raise TypeError("'expires' should be date, not datetime."
+                        " Use 'max_age' keyword arg instead.")
+    elif isinstance(expires, dt.date):
+        return http_datetime(expires)
+    ## timedeltaなら、現在日時からの相対時間とみなす
+    elif isinstance(expires, dt.timedelta):
+        return http_date_clock.after(int(expires.total_seconds()))
+    return expires
+
+
+## quote_plus() は遅いので、エンコード不要な文字だけならそのまま返す
+## (re を import しなくて済むよう、正規表現ではなく str.translate() で調べる)
+def _quote_cookie(s):
+    if not s.translate(_COOKIE_SAFE_TABLE):
+        return s
+    return _urlparse.quote_plus(s)
+
+_COOKIE_SAFE_TABLE = dict.fromkeys(map(ord, "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+                                            "abcdefghijklmnopqrstuvwxyz"
+                                            "0123456789-_.~"))
+
+
+def http_datetime(dt):
+    ## 同じ日時が続けて指定されることが多いので、直前の結果を再利用する
+    global _http_datetime_last
+    last_dt, last_str = _http_datetime_last
+    if dt == last_dt and type(dt) is type(last_dt):
+        return last_str
+    ## strftime()は、ロケールによっては月名や曜日名が英語にならないことがある
+    #return dt.strftime('%a, %d %b %Y %H:%M:%S GMT')
+    ## かわりに、月名と曜日名を自前で設定する
+    ## また strftime() と format() を使うより、% で組み立てるほうが速い
+    w    = dt.weekday()  # Mon: 0, Tue: 1, ...., Sat: 5, Sun: 6
+    wday = _WEEKDAYS[w]
+    mon  = _MONTHS[dt.month]
+    ## なおHTTPでの日時はGMTを使うので、必ずUTCのdatetimeを使うこと
+    H, M, S = ((dt.hour, dt.minute, dt.second) if isinstance(dt, _datetime.datetime)
+               else (0, 0, 0))
+    ## ex: 'Sat, 01 Jan 2000 12:34:56 GMT'
+    s = "%s, %02d %s %04d %02d:%02d:%02d GMT" % (wday, dt.day, mon, dt.year,
+                                                 H, M, S)
+    _http_datetime_last = (dt, s)
+    return s
+
+_http_datetime_last = (None, None)
+
+
+## エポック秒からHTTPの日時文字列を作る (Last-Modified などで使う)
+def http_timestamp(secs):
+    t = time.gmtime(secs)
+    ## ex: 'Sat, 01 Jan 2000 12:34:56 GMT'
+    return "%s, %02d %s %04d %02d:%02d:%02d GMT" % (
+        _WEEKDAYS[t.tm_wday], t.tm_mday, _MONTHS[t.tm_mon], t.tm_year,
+        t.tm_hour, t.tm_min, t.tm_sec)
+
+
+## 現在日時の文字列は1秒に1回しか変わらないので、1秒間はキャッシュする
+class HttpDateClock(object):
+
+    def __init__(self, timer=time.time):
+        self._timer  = timer
+        self._lock   = threading.Lock()
+        self._cached = {}    # ex: {0: (946730096, 'Sat, 01 Jan 2000 12:34:56 GMT')}
+
+    ## 現在日時
+    def now(self):
+        return self.after(0)
+
+    ## 現在日時から offset 秒後 (クッキーの Expires など)
+    def after(self, offset):
+        sec = int(self._timer())
+        t = self._cached.get(offset)
+        if t is not None and t[0] == sec:
+            return t[1]
+        ## 複数のスレッドが同時に作り直さないよう、ロックしてから再確認する
+        with self._lock:
+            t = self._cached.get(offset)
+            if t is None or t[0] != sec:
+                if len(self._cached) > 100:
+                    self._cached.clear()
+                t = (sec, http_timestamp(sec + offset))
+                self._cached[offset] = t
+        return t[1]
+
+http_date_clock = HttpDateClock()
+
+_WEEKDAYS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+_MONTHS   = (None, 'Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+                   'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+
+
+class Session(dict):
+
+    def __init__(self, sid=None, data=None, is_new=False):
+        dict.__init__(self, data or {})
+        self.sid      = sid
+        self.is_new   = is_new
+        self.modified = False
+
+    def __setitem__(self, key, val):
+        dict.__setitem__(self, key, val)
+        self.modified = True
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self.modified = True
+
+    def _modifier(name):
+        meth = getattr(dict, name)
+        def func(self, *args, **kwargs):
+            self.modified = True
+            return meth(self, *args, **kwargs)
+        func.__name__ = name
+        return func
+
+    pop        = _modifier('pop')
+    popitem    = _modifier('popitem')
+    clear      = _modifier('clear')
+    update     = _modifier('update')
+    setdefault = _modifier('setdefault')
+    del _modifier
+
+
+class BaseSessionStore(object):
+
+    def __init__(self, cookie=None):
+        if cookie is None:
+            cookie = CookieTemplate('sess', path='/', httponly=True)
+        self.cookie = cookie
+
+    ## リクエストのクッキーからセッションを取り出す
+    def load(self, req):
+        raise NotImplementedError("%s.load(): not implemented yet." % self.__class__.__name__)
+
+    ## セッションを保存し、必要ならクッキーをレスポンスに追加する
+    def save(self, session, resp):
+        raise NotImplementedError("%s.save(): not implemented yet." % self.__class__.__name__)
+
+
+## セッションの中身をすべてクッキーに入れる。
+## 改ざんを防ぐため HMAC で署名するが、暗号化はしないので秘密の値は入れないこと。
+class CookieSessionStore(BaseSessionStore):
+
+    MAX_COOKIE_SIZE = 4000
+
+    def __init__(self, secret, cookie=None):
+        BaseSessionStore.__init__(self, cookie)
+        if not secret:
+            raise ValueError("CookieSessionStore: secret required.")
+        if isinstance(secret, str):
+            secret = secret.encode('utf-8')
+        self._secret = secret
+
+    def load(self, req):
+        data = self._decode(req.cookies.get(self.cookie.name))
+        if data is None:
+            return Session(None, {}, is_new=True)
+        return Session(None, data)
+
+    def save(self, session, resp):
+        value = self._encode(dict(session))
+        if len(value) > self.MAX_COOKIE_SIZE:
+            raise ValueError("session data too large for cookie (%s bytes)." % len(value))
+        resp.add_cookie(self.cookie, value)
+
+    def _sign(self, payload):
+        return hmac.new(self._secret, payload, hashlib.sha256).hexdigest()
+
+    def _encode(self, data):
+        ## ex: {"x":1} -> 'eyJ4IjoxfQ.5d1f...'
+        binary  = json.dumps(data, separators=(',', ':')).encode('utf-8')
+        payload = base64.urlsafe_b64encode(binary).rstrip(b'=')
+        return "%s.%s" % (payload.decode('ascii'), self._sign(payload))
+
+    def _decode(self, value):
+        if not value or '.' not in value:
+            return None
+        payload, sig = value.rsplit('.', 1)
+        payload = payload.encode('ascii', 'replace')
+        ## 比較には、タイミング攻撃を防ぐため compare_digest() を使う
+        ## (str 同士の比較は ASCII 以外の文字で TypeError になるので、バイト列で比べる)
+        sig = sig.encode('ascii', 'replace')
+        if not hmac.compare_digest(self._sign(payload).encode('ascii'), sig):
+            return None
+        try:
+            binary = base64.urlsafe_b64decode(payload + b'=' * (-len(payload) % 4))
+            data   = json.loads(binary.decode('utf-8'))
+        except ValueError:
+            return None
+        return data if isinstance(data, dict) else None
+
+
+## セッションIDだけをクッキーに入れ、中身はサーバ側に保存する。
+## 最近使ったセッションはプロセス内の LRU キャッシュに残しておく。
+class ServerSessionStore(BaseSessionStore):
+
+    CACHE_SIZE = 1000
+
+    def __init__(self, cookie=None, cache_size=None):
+        BaseSessionStore.__init__(self, cookie)
+        self._cache_size = cache_size or self.CACHE_SIZE
+        self._cache = collections.OrderedDict()
+        self._lock  = threading.Lock()
+
+    def load(self, req):
+        sid  = req.cookies.get(self.cookie.name)
+        data = self._get(sid) if sid else None
+        if data is None:
+            sid = secrets.token_urlsafe(24)
+            return Session(sid, {}, is_new=True)
+        return Session(sid, data)
+
+    def save(self, session, resp):
+        data = dict(session)
+        self._store_data(session.sid, data)
+        self._put(session.sid, data)
+        if session.is_new:
+            resp.add_cookie(self.cookie, session.sid)
+
+    def delete(self, sid):
+        with self._lock:
+            self._cache.pop(sid, None)
+        self._delete_data(sid)
+
+    def _get(self, sid):
+        cache = self._cache
+        with self._lock:
+            data = cache.get(sid)
+            if data is not None:
+                cache.move_to_end(sid)
+                return data
+        data = self._load_data(sid)
+        if data is not None:
+            self._put(sid, data)
+        return data
+
+    def _put(self, sid, data):
+        cache = self._cache
+        with self._lock:
+            cache[sid] = data
+            cache.move_to_end(sid)
+            while len(cache) > self._cache_size:
+                cache.popitem(last=False)
+
+    ## サブクラスで、セッションの中身を読み書きする処理を定義する
+    def _load_data(self, sid):
+        return None
+
+    def _store_data(self, sid, data):
+        pass
+
+    def _delete_data(self, sid):
+        pass
+
+
+## LRU キャッシュだけを使う。プロセスを再起動するとセッションは消える。
+class MemorySessionStore(ServerSessionStore):
+    pass
+
+
+## セッションの中身を SQLite に保存する
+class SqliteSessionStore(ServerSessionStore):
+
+    def __init__(self, dbfile, cookie=None, cache_size=None):
+        ServerSessionStore.__init__(self, cookie, cache_size)
+        import sqlite3
+        self._sqlite3 = sqlite3
+        self._dbfile  = dbfile
+        self._local   = threading.local()   # 接続はスレッドごとに作る
+        self._conn().execute("CREATE TABLE IF NOT EXISTS sessions"
+                             " (sid TEXT PRIMARY KEY, data TEXT, updated_at REAL)")
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._sqlite3.connect(self._dbfile, isolation_level=None)
+            self._local.conn = conn
+        return conn
+
+    def _load_data(self, sid):
+        sql = "SELECT data FROM sessions WHERE sid = ?"
+        row = self._conn().execute(sql, (sid,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _store_data(self, sid, data):
+        sql = "INSERT OR REPLACE INTO sessions (sid, data, updated_at) VALUES (?, ?, ?)"
+        self._conn().execute(sql, (sid, json.dumps(data), time.time()))
+
+    def _delete_data(self, sid):
+        self._conn().execute("DELETE FROM sessions WHERE sid = ?", (sid,))
+
+
+class BaseAction(object):
+
+    ## セッションを使う場合は、セッションストアを設定する
+    ## ex: SESSION_STORE = CookieSessionStore(secret="...")
+    SESSION_STORE = None
+
+    def __init__(self, req, resp):
+        self.req  = req
+        self.resp = resp
+
+    ## セッションは、参照されたときに初めて読み込む
+    @property
+    def session(self):
+        if not hasattr(self, '_session'):
+            if self.SESSION_STORE is None:
+                raise ValueError("%s: SESSION_STORE is not set." % self.__class__.__name__)
+            self._session = self.SESSION_STORE.load(self.req)
+        return self._session
+
+    def before_action(self):
+        pass
+
+    def after_action(self, ex):
+        pass
+
+    def invoke_action(self, func, kwargs):
+        content = func(self, **kwargs)
+        timer = self.req.timer
+        if timer: timer.lap('action')
+        return content
+
+    def handle_action(self, func, kwargs):
+        timer = self.req.timer
+        ex = None
+        try:
+            self.before_action()
+            if timer: timer.lap('before_action')
+            content = self.invoke_action(func, kwargs)
+        except Exception as ex_:
+            ex = ex_
+            raise
+        finally:
+            self.after_action(ex)
+            if timer: timer.lap('after_action')
+            if isinstance(ex, HttpException):
+                self._save_session(ex)
+        self._save_session()
+        return content
+
+    ## セッションが変更されたときだけ保存する。
+    ## HttpException (リダイレクトなど) のときは、クッキーを例外に引き継ぐ。
+    def _save_session(self, ex=None):
+        sess = self.__dict__.get('_session')
+        if sess is not None and sess.modified:
+            self.SESSION_STORE.save(sess, self.resp)
+        if ex is not None and self.resp._cookies:
+            ex.cookies = self.resp._cookies
+
+
+class Action(BaseAction):
+
+    def invoke_action(self, func, kwargs):
+        content = BaseAction.invoke_action(self, func, kwargs)
+        if isinstance(content, dict):
+            content = json.dumps(content, ensure_ascii=False)
+            self.resp.content_type = "application/json"
+            timer = self.req.timer
+            if timer: timer.lap('json')
+        return content
+
+
+def on(req_meth, urlpath):
+    localvars = sys._getframe(1).f_locals
+    mapping = localvars.setdefault('__mapping__', [])
+    for upath, funcs in mapping:
+        if upath == urlpath:
+            break
+    else:
+        funcs = {}
+        mapping.append((urlpath, funcs))
+    if req_meth in funcs:
+        raise ValueError("@on(%r, %r): duplicated." % (req_meth, urlpath))
+    def deco(func):
+        funcs[req_meth] = func
+        return func
+    return deco
+
+
+class HelloAction(Action):
+
+    ITEMS = [
+        {"name": "Alice"},
+        {"name": "Bob"},
+        {"name": "Charlie"},
+    ]
+
+    @on('GET', r'.json')
+    def do_index(self):
+        return {
+            "items": self.ITEMS,
+        }
+
+    @on('GET', r'/{name:<\w+>}.json')
+    def do_show(self, name):
+        for x in self.ITEMS:
+            if x['name'] == name:
+                break
+        else:
+            self.resp.status = "404 Not Found"
+            return {"error": "404 Not Found"}
+        msg = "Hello, %s!" % name
+        return {"message": msg}
+
+
+class EnvironAction(Action):
+
+    @on('GET', r'')
+    def do_render(self):
+        environ = self.req.environ
+        buf = []
+        for key in sorted(environ.keys()):
+            if key in os.environ:
+                continue
+            val = environ[key]
+            typ = "(%s)" % type(val).__name__
+            buf.append("%-25s %-7s %r\n" % (key, typ, val))
+        content = "".join(buf)
+        self.resp.content_type = "text/plain;charset=utf-8"
+        return content
+
+
+class FormAction(Action):
+
+    @on('GET', r'')
+    def do_form(self):
+        req_meth = self.req.method
+        html = ('<p>self.req.method: %r</p>\n'
+                '<p>self.req.query: %s</p>\n'
+                '<form method="POST" action="/public/form"\n'
+                '      enctype="multipart/form-data">\n'
+                '  Name:<br>\n'
+                '  <input type="text" name="name"><br>\n'
+                '  Comment:<br>\n'
+                '  <textarea name="comment"></textarea><br>\n'
+                '  File:<br>\n'
+                '  <input type="file" name="upfile"><br>\n'
+                '  <input type="submit">\n'
+                '</form>\n')
+        r = self.req
+        return html % (r.method, h(repr(r.query)))
+
+    @on('POST', r'')
+    def do_post(self):
+        pair = self.req.multipart
+        html = ('<p>self.req.method: %r</p>\n'
+                '<p>self.req.query: %s</p>\n'
+                '<p>self.req.multipart: %s</p>\n'
+                '<p><a href="/public/form">back</p>\n')
+        r = self.req
+        return html % (r.method, h(repr(r.query)), h(repr(r.multipart)))
+
+
+class SessionAction(Action):
+
+    SESSION_STORE = MemorySessionStore()
+
+    @on('GET', r'')
+    def do_count(self):
+        count = self.session.get('count', 0) + 1
+        self.session['count'] = count
+        return {"count": count}
+
+
+mapping_list = [
+    ['/public', [
+        ('/hello'    , HelloAction),
+        ('/environ'  , EnvironAction),
+        ('/form'     , FormAction),
+        ('/session'  , SessionAction),
+    ]],
+]
+
+
+## 集計結果を返すアクション。使う場合はマッピングリストに追加し、
+## WSGIApplication(..., profiler=Profiler(default_metrics)) とすること。
+class MetricsAction(Action):
+
+    METRICS = None    # None なら default_metrics を使う
+
+    @on('GET', r'')
+    def do_metrics(self):
+        metrics = self.METRICS or default_metrics
+        self.resp.content_type = "text/plain; version=0.0.4; charset=utf-8"
+        return metrics.render_prometheus()
+
+
+## 最初に match() が呼ばれたときに、URLパスパターンを正規表現にコンパイルする。
+## コンパイル後は、インスタンス変数の match が正規表現オブジェクトのメソッドになる。
+class _LazyRexp(object):
+
+    def __init__(self, convert, urlpath):
+        self._convert = convert
+        self._urlpath = urlpath
+
+    def compile(self):
+        rexp = re.compile(self._convert(self._urlpath))
+        self.pattern = rexp.pattern
+        self.match   = rexp.match
+        return rexp
+
+    def match(self, string):
+        return self.compile().match(string)
+
+    def __getattr__(self, name):   # ex: 'pattern', 'groupindex'
+        return getattr(self.compile(), name)
+
+
+class ActionMapping(object):
+
+    def __init__(self, mapping_list):
+        self._fixed_dict    = {}
+        self._variable_list = []
+        for t in self._build(mapping_list, []):
+            full_urlpath, klass, funcs, rexp, prefix = t
+            if prefix is None:
+                self._fixed_dict[full_urlpath] = (klass, funcs, full_urlpath)
+            else:
+                self._variable_list.append(t)
+
+    ## 正規表現をまとめてコンパイルする。
+    ## prefork する前に呼べば、各ワーカーでのコンパイルが不要になる。
+    def compile_all(self):
+        for _, _, _, rexp, _ in self._variable_list:
+            if isinstance(rexp, _LazyRexp):
+                rexp.compile()
+
+    def _build(self, mapping_list, new_list, base_urlpath=""):
+        for urlpath, target in mapping_list:
+            current_urlpath = base_urlpath + urlpath
+            if isinstance(target, list):
+                child_list = target
+                self._build(child_list, new_list, current_urlpath)
+            else:
+                klass = target
+                self._validate_action_class(klass)
+                for upath, funcs in getattr(klass, '__mapping__'):
+                    full_urlpath = current_urlpath + upath
+                    ## 正規表現は、最初に使うときにコンパイルする
+                    rexp = _LazyRexp(self._convert_urlpath, full_urlpath)
+                    i = full_urlpath.find('{')
+                    prefix = (full_urlpath[:i] if i >= 0 else None)
+                    #
+                    t = (full_urlpath, klass, funcs, rexp, prefix)
+                    new_list.append(t)
+        return new_list
+
+    def _validate_action_class(self, klass):
+        if not isinstance(klass, type):
+            raise TypeError("%r: expected action class." % (klass,))
+        if not issubclass(klass, BaseAction):
+            raise TypeError("%r: should be a subclass of BaseAction." % klass)
+        if not hasattr(klass, '__mapping__'):
+            raise ValueError("%r: no mapping data." % klass)
+
+    def _convert_urlpath(self, urlpath):   # ex: '/api/foo/{id}.json'
+        def _re_escape(string):
+            return re.escape(string).replace(r'\/', '/')
+        #
+        param_rexps = {'str': r'[^/]+', 'int': r'\d+'}
+        buf = ['^']; add = buf.append
+        pos = 0
+        for m in re.finditer(r'(.*?)\{(\w+)(:\w*)?(<[^>]*>)?\}', urlpath):
+            pos = m.end(0)                   # ex: 13
+            string, pname, ptype, prexp = m.groups()  # ex: ('/api/foo/', 'id')
+            if ptype: ptype = ptype[1:]      # ex: ':int' -> 'int'
+            if prexp: prexp = prexp[1:-1]    # ex: '<\d+>' -> '\d+'
+            #
+            if not ptype:
+                ptype = 'str'
+            if ptype not in param_rexps:
+                raise ValueError("%r: contains unknown data type %r." \
+                                     % (urlpath, ptype))
+            if not prexp:
+                prexp = param_rexps[ptype]
+            #
+            add(_re_escape(string))
+            add('(?P<%s>%s)' % (pname, prexp))  # ex: '(?P<id>[^/]+)'
+        remained = urlpath[pos:]  # ex: '.json'
+        add(_re_escape(remained))
+        add('$')
+        return "".join(buf)   # ex: '^/api/foo/(?P<id>[^/]+)\\.json$'
+
+    def lookup(self, req_path):
+        t = self._fixed_dict.get(req_path)
+        if t:
+            klass, funcs, urlpath = t
+            kwargs = {}
+            return klass, funcs, kwargs, urlpath
+        for urlpath, klass, funcs, rexp, prefix in self._variable_list:
+            if not req_path.startswith(prefix):
+                continue
+            m = rexp.match(req_path)
+            if m:
+                kwargs = m.groupdict()  # ex: {"id": 123}
+                ## 計測などで使うため、URLパスパターンも返す
+                # ex: return FooAction, {"GET": do_show}, {"id": 123}, '/foo/{id}'
+                return klass, funcs, kwargs, urlpath
+        return None, None, None, None
+
+
+## リクエストごとに作られ、処理の段階ごとの経過時間を記録する
+class PhaseTimer(object):
+
+    def __init__(self, method, clock=time.perf_counter):
+        self.method  = method
+        self.route   = None    # ex: '/api/foo/{id}'
+        self.status  = None
+        self.timings = []      # ex: [('lookup', 0.000012), ('action', 0.0031)]
+        self.headers = []      # レスポンスヘッダに追加するもの
+        self._clock  = clock
+        self._start  = self._last = clock()
+
+    ## 前回から今回までの経過時間を、段階名をつけて記録する
+    def lap(self, phase):
+        now = self._clock()
+        self.timings.append((phase, now - self._last))
+        self._last = now
+
+    @property
+    def total(self):
+        return self._last - self._start
+
+
+class Profiler(object):
+
+    def __init__(self, *sinks):
+        self.sinks = sinks
+
+    def start(self, environ):
+        return PhaseTimer(environ['REQUEST_METHOD'])
+
+    def finish(self, timer):
+        for sink in self.sinks:
+            sink.record(timer)
+
+
+## 計測結果をメモリ上に集計する。
+## 経過時間は、2のべき乗(マイクロ秒)ごとのバケツで数える。
+class HistogramSink(object):
+
+    def __init__(self):
+        self._lock  = threading.Lock()
+        self._stats = {}    # ex: {('/foo/{id}', 'action'): [count, total, max, {bucket: n}]}
+
+    def record(self, timer):
+        route = timer.route or "(not found)"
+        items = timer.timings + [('total', timer.total)]
+        with self._lock:
+            stats = self._stats
+            for phase, sec in items:
+                key = (route, phase)
+                st = stats.get(key)
+                if st is None:
+                    st = stats[key] = [0, 0.0, 0.0, {}]
+                st[0] += 1
+                st[1] += sec
+                if sec > st[2]:
+                    st[2] = sec
+                bucket = int(sec * 1000000).bit_length()   # ex: 100usec -> 7
+                st[3][bucket] = st[3].get(bucket, 0) + 1
+
+    def stats(self):
+        with self._lock:
+            return { k: (v[0], v[1], v[2], dict(v[3])) for k, v in self._stats.items() }
+
+    def report(self):
+        buf = []
+        for (route, phase), (count, total, max_, _) in sorted(self.stats().items()):
+            buf.append("%-30s %-14s count=%-6d avg=%.3fms max=%.3fms\n"
+                       % (route, phase, count, total / count * 1000, max_ * 1000))
+        return "".join(buf)
+
+
+## 計測結果をログに出力する
+class LogSink(object):
+
+    def __init__(self, logger=None):
+        if logger is None:
+            import logging
+            logger = logging.getLogger(__name__)
+        self._logger = logger
+
+    def record(self, timer):
+        s = " ".join("%s=%.3fms" % (phase, sec * 1000) for phase, sec in timer.timings)
+        self._logger.info("%s %s %s total=%.3fms %s", timer.method, timer.route,
+                          timer.status, timer.total * 1000, s)
+
+
+## 計測結果を Server-Timing ヘッダとしてブラウザに返す
+class ServerTimingSink(object):
+
+    def record(self, timer):
+        s = ", ".join("%s;dur=%.3f" % (phase, sec * 1000) for phase, sec in timer.timings)
+        timer.headers.append(('Server-Timing', s))
+
+
+## HDR Histogram 風のヒストグラム。
+## 値(マイクロ秒)を2のべき乗ごとに区切り、さらにそれを SUB_COUNT 個に区切って数える。
+## 相対誤差は 1/SUB_COUNT 以下になる。
+class LatencyHistogram(object):
+
+    SUB_BITS  = 3
+    SUB_COUNT = 1 << SUB_BITS   # 8
+    SIZE      = 256             # 約 2^31 マイクロ秒 (約35分) まで
+
+    def __init__(self):
+        self.count  = 0
+        self.sum    = 0.0           # seconds
+        self.counts = [0] * self.SIZE
+
+    @classmethod
+    def index(cls, usec):
+        if usec < 2 * cls.SUB_COUNT:
+            return usec
+        e = usec.bit_length() - (cls.SUB_BITS + 1)
+        i = (e + 1) * cls.SUB_COUNT + (usec >> e) - cls.SUB_COUNT
+        return i if i < cls.SIZE else cls.SIZE - 1
+
+    @classmethod
+    def upper_bound(cls, index):   # マイクロ秒
+        if index < 2 * cls.SUB_COUNT:
+            return index + 1
+        e = index // cls.SUB_COUNT - 1
+        m = index % cls.SUB_COUNT + cls.SUB_COUNT
+        return (m + 1) << e
+
+    def add(self, sec):
+        self.count += 1
+        self.sum   += sec
+        self.counts[self.index(int(sec * 1000000))] += 1
+
+    def merge(self, other):
+        self.count += other.count
+        self.sum   += other.sum
+        counts = self.counts
+        for i, n in enumerate(other.counts):
+            if n:
+                counts[i] += n
+
+    def percentile(self, p):   # ex: p=99.0 -> seconds
+        if not self.count:
+            return 0.0
+        threshold = self.count * p / 100.0
+        n = 0
+        for i, c in enumerate(self.counts):
+            n += c
+            if n >= threshold:
+                return self.upper_bound(i) / 1000000.0
+        return self.upper_bound(self.SIZE - 1) / 1000000.0
+
+
+## スレッドごとの集計データを持つ (スレッドの終了を weakref で検知するため)
+class _ThreadTable(object):
+
+    def __init__(self):
+        self.table = {}
+
+
+## (URLパスパターン, リクエストメソッド, ステータス) ごとにリクエスト数とレイテンシを集計する。
+## 集計データはスレッドごとに持つのでロックは不要で、読み出すときにまとめる。
+class MetricsSink(object):
+
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self._local   = threading.local()
+        self._tables  = {}    # 実行中の全スレッドの集計データ (ex: {id(table): table})
+        self._retired = {}    # 終了したスレッドの集計データをまとめたもの
+        self._lock    = threading.Lock()   # 登録時と終了時にだけ使う
+
+    def _table(self):
+        try:
+            return self._local.holder.table
+        except AttributeError:
+            import weakref
+            holder = self._local.holder = _ThreadTable()
+            table = holder.table
+            with self._lock:
+                self._tables[id(table)] = table
+            ## スレッドが終了すると holder が解放されるので、そのときに
+            ## 集計データを _retired へまとめる (接続ごとにスレッドを作るサーバ対策)
+            weakref.finalize(holder, self._retire, table)
+            return table
+
+    def _retire(self, table):
+        with self._lock:
+            self._tables.pop(id(table), None)
+            self._merge_into(self._retired, table)
+
+    def record(self, timer):
+        status = timer.status or ""
+        key = (timer.route or "(not found)", timer.method, status[:1] + "xx")  # ex: '2xx'
+        table = self._table()
+        hist = table.get(key)
+        if hist is None:
+            hist = table[key] = LatencyHistogram()
+        hist.add(timer.total)
+
+    def collect(self):
+        merged = {}
+        ## 終了したスレッドの分は _retire() が書き換えるので、ロックしたまままとめる
+        with self._lock:
+            tables = list(self._tables.values())
+            self._merge_into(merged, self._retired)
+        for table in tables:
+            self._merge_into(merged, table.copy())
+        return merged   # ex: {('/foo/{id}', 'GET', '2xx'): LatencyHistogram}
+
+    @staticmethod
+    def _merge_into(merged, table):
+        for key, hist in table.items():
+            m = merged.get(key)
+            if m is None:
+                m = merged[key] = LatencyHistogram()
+            m.merge(hist)
+
+    ## Prometheus のテキスト形式で出力する
+    def render_prometheus(self):
+        buf = []; add = buf.append
+        merged = sorted(self.collect().items())
+        add("# TYPE http_requests_total counter\n")
+        for key, hist in merged:
+            add("http_requests_total{%s} %d\n" % (_prom_labels(key), hist.count))
+        add("# TYPE http_request_duration_seconds histogram\n")
+        upper = LatencyHistogram.upper_bound
+        for key, hist in merged:
+            labels = _prom_labels(key)
+            i = 0; n = 0
+            for le in self.BUCKETS:
+                limit = le * 1000000
+                while i < hist.SIZE and upper(i) <= limit:
+                    n += hist.counts[i]
+                    i += 1
+                add('http_request_duration_seconds_bucket{%s,le="%s"} %d\n' % (labels, le, n))
+            add('http_request_duration_seconds_bucket{%s,le="+Inf"} %d\n' % (labels, hist.count))
+            add("http_request_duration_seconds_sum{%s} %.6f\n" % (labels, hist.sum))
+            add("http_request_duration_seconds_count{%s} %d\n" % (labels, hist.count))
+        return "".join(buf)
+
+
+def _prom_labels(key):
+    route, method, status = key
+    esc = lambda s: s.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return 'route="%s",method="%s",status="%s"' % (esc(route), esc(method), status)
+
+
+default_metrics = MetricsSink()
+
+
+## 一部のリクエストだけをプロファイラの下で実行し、結果をURLパスパターンごとに集める。
+## 対象になるのは、rate の割合でランダムに選ばれたリクエストと、
+## header で指定したヘッダの値が token と一致するリクエスト。
+## 誰でもプロファイルを有効にできないよう、header を使うときは token が必須。
+##   ex: RequestSampler(header='HTTP_X_PROFILE', token=os.environ['PROFILE_TOKEN'])
+##   mode='cprofile' : cProfile で計測する。結果は pstats()/report() で取り出す。
+##   mode='sampling' : 別スレッドから interval 秒ごとにスタックを採取する。
+##                     結果は collapsed() でフレームグラフ用の形式で取り出す。
+class RequestSampler(object):
+
+    def __init__(self, rate=0.0, header=None, token=None, mode='cprofile',
+                 interval=0.005):
+        if mode not in ('cprofile', 'sampling'):
+            raise ValueError("%r: unknown profiling mode." % (mode,))
+        if header and not token:
+            raise ValueError("%r: secret token required to enable profiling by header." % (header,))
+        self.rate     = rate
+        self.header   = header
+        self._token   = token.encode('utf-8') if token else None
+        self.mode     = mode
+        self.interval = interval
+        self._lock    = threading.Lock()
+        self._stats   = {}    # ex: {'/foo/{id}': pstats.Stats}
+        self._stacks  = {}    # ex: {'/foo/{id}': {'main;foo;bar': 12}}
+        self._active  = {}    # ex: {thread_id: '/foo/{id}'}
+        self._thread  = None
+        self._wakeup  = threading.Event()
+        ## cProfile は同時に1つしか動かせないので、使用中ならプロファイルしない
+        self._cprofile_lock = threading.Lock()
+
+    def should_sample(self, environ):
+        if self.header:
+            value = environ.get(self.header)
+            if value and hmac.compare_digest(value.encode('utf-8'), self._token):
+                return True
+        return self.rate > 0 and random.random() < self.rate
+
+    def run(self, route, func, *args):
+        route = route or "(not found)"
+        if self.mode == 'cprofile':
+            return self._run_cprofile(route, func, args)
+        else:
+            return self._run_sampling(route, func, args)
+
+    def _run_cprofile(self, route, func, args):
+        if not self._cprofile_lock.acquire(blocking=False):
+            return func(*args)
+        try:
+            import cProfile
+            prof = cProfile.Profile()
+            try:
+                return prof.runcall(func, *args)
+            finally:
+                self._add_stats(route, prof)
+        finally:
+            self._cprofile_lock.release()
+
+    def _add_stats(self, route, prof):
+        import pstats
+        with self._lock:
+            st = self._stats.get(route)
+            if st is None:
+                self._stats[route] = pstats.Stats(prof)
+            else:
+                st.add(prof)
+
+    def _run_sampling(self, route, func, args):
+        tid = threading.get_ident()
+        with self._lock:
+            self._active[tid] = route
+            if self._thread is None:
+                t = threading.Thread(target=self._sampling_loop, daemon=True)
+                t.start()
+                self._thread = t
+        self._wakeup.set()
+        try:
+            return func(*args)
+        finally:
+            with self._lock:
+                self._active.pop(tid, None)
+
+    def _sampling_loop(self):
+        while True:
+            self._wakeup.wait()
+            with self._lock:
+                active = dict(self._active)
+                if not active:
+                    self._wakeup.clear()
+                    continue
+            frames = sys._current_frames()
+            for tid, route in active.items():
+                frame = frames.get(tid)
+                if frame is not None:
+                    self._add_stack(route, frame)
+            del frames
+            time.sleep(self.interval)
+
+    def _add_stack(self, route, frame):
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append("%s (%s)" % (code.co_name, os.path.basename(code.co_filename)))
+            frame = frame.f_back
+        names.reverse()
+        key = ";".join(names)    # ex: 'main (app.py);foo (app.py);bar (app.py)'
+        with self._lock:
+            d = self._stacks.setdefault(route, {})
+            d[key] = d.get(key, 0) + 1
+
+    def routes(self):
+        with self._lock:
+            return sorted(set(self._stats) | set(self._stacks))
+
+    ## cProfile の結果を pstats.Stats オブジェクトとして返す
+    ## (ファイルに保存するなら、.dump_stats(filename) を使う)
+    def pstats(self, route):
+        with self._lock:
+            return self._stats.get(route)
+
+    def report(self, route, sort='cumulative', limit=30):
+        import io
+        st = self.pstats(route)
+        if st is None:
+            return ""
+        out = io.StringIO()
+        st.stream = out
+        st.sort_stats(sort).print_stats(limit)
+        return out.getvalue()
+
+    ## フレームグラフ (flamegraph.pl など) 用の形式で返す
+    ## ex: 'main (app.py);foo (app.py);bar (app.py) 12\n'
+    def collapsed(self, route):
+        with self._lock:
+            d = dict(self._stacks.get(route) or {})
+        return "".join("%s %d\n" % (k, n) for k, n in sorted(d.items()))
+
+
+class WSGIApplication(object):
+
+    def __init__(self, mapping_list, auto_redirect=True, profiler=None,
+                 sampler=None):
+        if isinstance(mapping_list, ActionMapping):
+            self._mapping = mapping_list
+        else:
+            self._mapping = ActionMapping(mapping_list)
+        self._auto_redirect = auto_redirect
+        self._profiler = profiler
+        self._sampler  = sampler
+
+    def lookup(self, req_path):
+        return self._mapping.lookup(req_path)
+
+    def __call__(self, environ, start_response):
+        ## 選ばれたリクエストだけ、プロファイラの下で実行する
+        sampler = self._sampler
+        if sampler is not None and sampler.should_sample(environ):
+            _, _, _, route = self.lookup(environ['PATH_INFO'])
+            return sampler.run(route, self._call, environ, start_response)
+        return self._call(environ, start_response)
+
+    def _call(self, environ, start_response):
+        ## 計測しないときは、余計な処理をいっさいしない
+        if self._profiler is not None:
+            return self._call_with_profiler(environ, start_response)
+        try:
+            status, header_list, content = self._handle_request(environ)
+        except HttpException as ex:
+            status, header_list, content = self._handle_http_exception(ex)
+        body = [content.encode('utf-8')]
+        start_response(status, header_list)
+        return body
+
+    def _call_with_profiler(self, environ, start_response):
+        timer = self._profiler.start(environ)
+        try:
+            status, header_list, content = self._handle_request(environ, timer)
+        except HttpException as ex:
+            status, header_list, content = self._handle_http_exception(ex)
+        body = [content.encode('utf-8')]
+        timer.lap('encode')
+        timer.status = status
+        self._profiler.finish(timer)
+        if timer.headers:
+            header_list.extend(timer.headers)
+        start_response(status, header_list)
+        return body
+
+    def _handle_request(self, environ, timer=None):
+        req  = Request(environ)
+        resp = Response()
+        if timer: timer.lap('request')
+        #
+        req_meth = req.method
+        req_path = req.path
+        klass, funcs, kwargs, route = self.lookup(req_path)
+        if timer:
+            timer.route = route
+            timer.lap('lookup')
+            req.timer = timer
+        #
+        if klass is None:
+            self._try_auto_redirect(req)
+            raise HttpException("404 Not Found")
+        if req_meth not in funcs:
+            raise HttpException("405 Method Not Allowed")
+        #
+        func    = funcs[req_meth]
+        action  = klass(req, resp)
+        content = action.handle_action(func, kwargs)
+        status  = resp.status
+        if req_meth == 'HEAD':
+            content = ""
+        #
+        header_list = resp.header_list()  # ex: [('Content-Type': 'text/html')]
+        if timer: timer.lap('response')
+        return status, header_list, content
+
+    def _handle_http_exception(self, ex):
+        content = ex.content or "<h2>%s</h2>" % ex.status
+        headers = {"Content-Type": "text/html;charset=utf-8",
+                   "Date": http_date_clock.now()}
+        if ex.headers:
+            headers.update(ex.headers)
+        header_list = list(headers.items())  # ex: {'X': 'Y'} -> [('X', 'Y')]
+        if ex.cookies:
+            header_list.extend( ('Set-Cookie', s) for s in ex.cookies )
+        return ex.status, header_list, content
+
+    def _try_auto_redirect(self, req):
+        if not self._auto_redirect:
+            return
+        if not req.method in ('GET', 'HEAD'):
+            return
+        s = req.path
+        rpath = (s[:-1] if s.endswith('/') else s+'/')
+        klass, _, _, _ = self.lookup(rpath)
+        if klass is None:
+            return
+        qs = req.query_string
+        location = "%s?%s" % (rpath, qs) if qs else rpath
+        raise HttpException("301 Moved Permanently", location,
+                            {'Location': location})
+
+
+wsgi_app = WSGIApplication(mapping_list)
+
+
+if __name__ == "__main__":
+    from wsgiref.simple_server import make_server
+    wsgi_server = make_server('localhost', 7000, wsgi_app)
+    wsgi_server.serve_forever()
@@ -0,0 +1,2338 @@
+# -*- coding: utf-8 -*-
+
+##
+## subject: テンプレートの出力をストリーミングする
+##
+
+import sys
+import os
+import time
+import threading
+import types
+
+
+## 起動を速くするため、特定の処理でしか使わないモジュールは最初に使うときに import する。
+## 一度取り出した属性はインスタンス変数として保存されるので、二回目以降は速い。
+class _LazyModule(object):
+
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attr):
+        name = self.__dict__['_name']
+        __import__(name)
+        val = getattr(sys.modules[name], attr)
+        setattr(self, attr, val)
+        return val
+
+    def __repr__(self):
+        return "<lazy module %r>" % self._name
+
+re          = _LazyModule('re')
+json        = _LazyModule('json')
+hmac        = _LazyModule('hmac')
+hashlib     = _LazyModule('hashlib')
+base64      = _LazyModule('base64')
+secrets     = _LazyModule('secrets')
+random      = _LazyModule('random')
+collections = _LazyModule('collections')
+_urlparse   = _LazyModule('urllib.parse')
+_html       = _LazyModule('html')
+_datetime   = _LazyModule('datetime')
+mimetypes   = _LazyModule('mimetypes')
+
+
+def h(s, quote=True):
+    return _html.escape(s, quote)
+
+
+class HttpException(Exception):
+
+    ## 例外でもクッキーを返すときに使う。 ex: ['sid=...; Path=/']
+    cookies = None
+
+    def __init__(self, status, content=None, headers=None):
+        self.status  = status
+        self.content = content
+        self.headers = headers
+
+
+class Request(object):
+
+    ## 計測中のときだけ、PhaseTimer オブジェクトが設定される
+    timer = None
+
+    def __init__(self, environ):
+        self.environ = environ
+        self.method  = environ['REQUEST_METHOD']
+        self.path    = environ['PATH_INFO']
+
+    @property
+    def query_string(self):
+        return self.environ['QUERY_STRING']
+
+    @property
+    def content_type(self):
+        return self.environ.get('CONTENT_TYPE')
+
+    @property
+    def content_length(self):
+        s = self.environ.get('CONTENT_LENGTH')
+        try:
+            return int(s) if s else None
+        except:
+            msg = "<p>%r: invalid content lenght.</p>"
+            raise HttpException(400, msg % (s,))
+
+    MAX_FORM_SIZE      =   1 * 1024 * 1024  #  2MB
+    MAX_JSON_SIZE      =   1 * 1024 * 1024  #  2MB
+    MAX_MULTIPART_SIZE =  10 * 1024 * 1024  # 10MB
+
+    @property
+    def query(self):
+        if not hasattr(self, '_query'):
+            self._query = _parse_query_str(self.query_string)
+        return self._query
+
+    @property
+    def form(self):
+        if not hasattr(self, '_form'):
+            self._check_ctype("application/x-www-form-urlencoded")
+            self._form = _parse_query_str(self._read_input(self.MAX_FORM_SIZE))
+        return self._form
+
+    @property
+    def json(self):
+        if not hasattr(self, '_json'):
+            self._check_ctype("application/json")
+            self._json = json.loads(self._read_input(self.MAX_JSON_SIZE))
+        return self._json
+
+    @property
+    def multipart(self):
+        if not hasattr(self, '_multipart'):
+            self._check_ctype("multipart/form-data")
+            mp = MultiPart(self.content_type)
+            strs, files = mp.parse(self._read_input(self.MAX_MULTIPART_SIZE))
+            self._multipart = (strs, files)
+        return self._multipart
+
+    def _read_input(self, max_size):
+        if hasattr(self, '_eof'):
+            return ""
+        if self.content_length is None:
+            raise _http400("content-length required.")
+        if self.content_length > max_size:
+            raise _http400("content-length too large.")
+        input   = self.environ['wsgi.input']
+        binary  = input.read(self.content_length)
+        self._eof = True
+        unicode = binary.decode('utf-8')
+        return unicode
+
+    def _check_ctype(self, expected):
+        ctype = self.content_type or ""
+        if not ctype.startswith(expected):
+            msg = "expected content type is %r, but actual is %r."
+            raise _http400(msg % (expected, ctype))
+
+    ## ポート番号を除いた、小文字のホスト名 (ex: 'www.example.com')
+    @property
+    def host(self):
+        if not hasattr(self, '_host'):
+            self._host = _normalize_host(self.environ)
+        return self._host
+
+    ## クッキーはすぐには解析せず、参照されたものだけを取り出す
+    @property
+    def cookies(self):
+        if not hasattr(self, '_cookies'):
+            cookie_str = self.environ.get('HTTP_COOKIE')
+            self._cookies = LazyCookies(cookie_str)
+        return self._cookies
+
+
+def _normalize_host(environ):
+    host = environ.get('HTTP_HOST') or environ.get('SERVER_NAME') or ""
+    if host.startswith('['):            # ex: '[::1]:8080' -> '[::1]'
+        i = host.find(']')
+        host = host[:i+1] if i >= 0 else host
+    else:                               # ex: 'Example.com:8080' -> 'example.com'
+        host = host.partition(':')[0]
+    return host.lower()
+
+
+def _parse_query_str(query_str):
+    d = {}
+    if not query_str:
+        return d
+    unq = _urlparse.unquote_plus
+    ss = query_str.split('&') # ex: 'x=1&y=2' -> ['x=1', 'y=2']
+    for s in ss:
+        kv = s.split('=', 1)  # ex: 'x=1' -> ['x', '1']; 'x' -> ['x']
+        if len(kv) == 2:
+            k, v = kv
+        else:
+            k = kv[0]; v = ""
+        k = unq(k); v = unq(v)
+        if k.endswith('[]'):
+            d.setdefault(k, []).append(v)
+        else:
+            d[k] = v
+    return d
+
+
+def _parse_cookie_str(cookie_str):
+    d = {}
+    if cookie_str:
+        unq = _unquote_if_needed
+        for s in cookie_str.split(';'):   # ex: 'x=1; y=2' -> ['x=1', ' y=2']
+            kv = s.strip().split('=', 1)  # ex: ' x=1' -> ['x', '1']; 'x' -> ['x']
+            k, v = kv if len(kv) == 2 else (kv[0], "")
+            d[unq(k)] = unq(v)
+    return d
+
+
+## '%' も '+' も含まなければ、unquote_plus() を呼ぶ必要はない
+def _unquote_if_needed(s):
+    if '%' in s or '+' in s:
+        return _urlparse.unquote_plus(s)
+    return s
+
+
+## 参照されたクッキーだけをデコードする、dict風のオブジェクト
+class LazyCookies(object):
+
+    def __init__(self, cookie_str):
+        self._cookie_str = cookie_str or ""
+        self._values     = {}     # ex: {'sid': 'abc123'}
+        self._parsed     = None   # result of _parse_cookie_str()
+        self._escaped    = None   # クッキー名にエスケープを含むものがあれば True
+
+    def get(self, name, default=None):
+        if self._parsed is not None:
+            return self._parsed.get(name, default)
+        d = self._values
+        if name in d:
+            return d[name]
+        val = self._find(name)
+        if val is None:
+            ## クッキー名がエンコードされている可能性があれば、全体を解析する
+            ## (値に '%' や '+' があるのはよくあることなので、名前だけを調べる)
+            if self._has_escaped_name():
+                return self._all().get(name, default)
+            return default
+        d[name] = val
+        return val
+
+    def __getitem__(self, name):
+        val = self.get(name)
+        if val is None:
+            raise KeyError(name)
+        return val
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+    def _has_escaped_name(self):
+        if self._escaped is None:
+            self._escaped = False
+            for item in self._cookie_str.split(';'):
+                key = item.partition('=')[0]
+                if '%' in key or '+' in key:
+                    self._escaped = True
+                    break
+        return self._escaped
+
+    def _find(self, name):
+        s = self._cookie_str
+        n = len(name)
+        if not n:
+            return None
+        end = len(s)
+        ## 同じ名前のクッキーは後ろのものが優先されるので、後ろから探す
+        while True:
+            i = s.rfind(name, 0, end)
+            if i < 0:
+                return None
+            end = i
+            ## 直前が ';' か先頭、直後が '=' か ';' か末尾であること
+            k = i - 1
+            while k >= 0 and s[k] in ' \t':
+                k -= 1
+            if k >= 0 and s[k] != ';':
+                continue
+            j = i + n
+            if j == len(s) or s[j] == ';':
+                return ""
+            if s[j] != '=':
+                continue
+            e = s.find(';', j)
+            val = s[j+1:e] if e >= 0 else s[j+1:]
+            return _unquote_if_needed(val.rstrip())
+
+    def _all(self):
+        if self._parsed is None:
+            self._parsed = _parse_cookie_str(self._cookie_str)
+        return self._parsed
+
+    def __iter__(self):
+        return iter(self._all())
+
+    def __len__(self):
+        return len(self._all())
+
+    def keys(self):
+        return self._all().keys()
+
+    def values(self):
+        return self._all().values()
+
+    def items(self):
+        return self._all().items()
+
+    def __eq__(self, other):
+        if isinstance(other, LazyCookies):
+            other = other._all()
+        return self._all() == other
+
+    def __repr__(self):
+        return repr(self._all())
+
+
+def _http400(msg):
+    status = "400 Bad Request"
+    content = "%s: %s" % (status, msg)
+    return HttpException(status, content)
+
+
+class MultiPart(object):
+
+    def __init__(self, content_type):
+        if not content_type:
+            raise _http400("content type required.")
+        if not content_type.startswith("multipart/form-data;"):
+            raise _http400("not a multipart.")
+        m = re.search(r'''boundary=(['"]?)([-\w]+)\1?''', content_type)
+        if not m:
+            raise _http400("boundary required.")
+        self.boundary = m.group(2)
+
+    def parse(self, string):
+        strs  = {}
+        files = {}
+        for t in self._each_entry(string):
+            name, val, filename = t
+            if not name:
+                continue
+            d = files if filename else strs
+            if filename:
+                v = (val, filename)
+                d = files
+            else:
+                v = val
+                d = strs
+            if name.endswith('[]'):
+                d.setdefault(name, []).append(v)
+            else:
+                d[name] = v
+        return strs, files
+
+    def _each_entry(self, string):
+        boundary  = self.boundary
+        separator = "\r\n--%s\r\n"   % boundary
+        preamble  =     "--%s\r\n"   % boundary
+        postamble = "\r\n--%s--\r\n" % boundary
+        arr = string.split(separator)
+        if not arr[0].startswith(preamble):
+            raise _http400("preamble unmatched.")
+        if not arr[-1].endswith(postamble):
+            raise _http400("postamble unmatched.")
+        arr[0]  = arr[0][len(preamble):]
+        arr[-1] = arr[-1][:-len(postamble)]
+        #
+        pat  = r'^Content-Disposition: *form-data(?:; *name="(.*?)")?(?:; *filename="(.*?)")?'
+        rexp = re.compile(pat, re.M | re.I)
+        for s in arr:
+            pair = s.split("\r\n\r\n", 1)
+            if len(pair) != 2:
+                raise _http400("missing header part.")
+            header, val = pair
+            m = rexp.search(header)
+            if not m:
+                raise _http400("invalid content disposition.")
+            name, filename = m.groups()
+            unq      = _urlparse.unquote_plus
+            name     = unq(name)     if name else None
+            filename = unq(filename) if filename else None
+            val      = unq(val)
+            yield name, val, filename
+
+
+class Response(object):
+
+    def __init__(self):
+        self.status  = "200 OK"
+        self.headers = {
+            'Content-Type': "text/html;charset=utf-8",
+        }
+        self._cookies = []
+
+    def header_list(self):
+        items = list(self.headers.items())
+        if 'Date' not in self.headers:
+            items.append(('Date', http_date_clock.now()))
+        if self._cookies:
+            k = 'Set-Cookie'
+            items.extend( (k, s) for s in self._cookies )
+        return items
+
+    @property
+    def content_type(self):
+        return self.headers['Content-Type']
+
+    @content_type.setter
+    def content_type(self, value):
+        self.headers['Content-Type'] = value
+
+    ## ex: self.resp.set_last_modified(os.path.getmtime(filepath))
+    def set_last_modified(self, mtime):
+        self.headers['Last-Modified'] = http_timestamp(int(mtime))
+
+    ## クッキーを追加する。名前と値は必須、それ以外は省略可。
+    ## 名前のかわりに CookieTemplate オブジェクトも指定できる。
+    def add_cookie(self, name, value,
+                   domain=None, path=None, expires=None, max_age=None,
+                   httponly=None, secure=None):
+        if isinstance(name, CookieTemplate):
+            cookie_str = name.render(value, expires)
+        else:
+            suffix = _cookie_attrs(domain, path, expires, max_age,
+                                   httponly, secure)
+            cookie_str = _quote_cookie(name) + "=" + _quote_cookie(value) + suffix
+        self._cookies.append(cookie_str)
+        return cookie_str
+
+    ## 過去の遠い日付をexpiresに設定することで、クッキーを無効化する
+    def expire_cookie(self, cookie_name,
+                      domain=None, path=None, max_age=None,
+                      httponly=None, secure=None):
+        if isinstance(cookie_name, CookieTemplate):
+            self._cookies.append(cookie_name.expired)
+            return
+        expires = _PAST_DATE
+        self.add_cookie(cookie_name, "",
+                        domain=domain, path=path, expires=expires, max_age=max_age,
+                        httponly=httponly, secure=secure)
+
+
+_PAST_DATE = 'Thu, 01 Jan 1970 00:00:00 GMT'
+
+
+## 毎回同じ属性を組み立てるのは無駄なので、属性部分をあらかじめ作っておく
+## ex:
+##   SESSION_COOKIE = CookieTemplate('sid', path='/', httponly=True)
+##   self.resp.add_cookie(SESSION_COOKIE, sid)
+class CookieTemplate(object):
+
+    def __init__(self, name,
+                 domain=None, path=None, max_age=None,
+                 httponly=None, secure=None):
+        self.name     = name
+        self._prefix  = _quote_cookie(name) + "="
+        self._suffix  = _cookie_attrs(domain, path, None, max_age,
+                                      httponly, secure)
+        ## 無効化用の文字列も作っておく (Max-Age は付けない)
+        self.expired  = self._prefix + _cookie_attrs(domain, path, _PAST_DATE,
+                                                     None, httponly, secure)
+
+    def render(self, value, expires=None):
+        s = self._prefix + _quote_cookie(value) + self._suffix
+        if expires is not None:
+            s += "; Expires=" + _expires_str(expires)
+        return s
+
+
+def _cookie_attrs(domain, path, expires, max_age, httponly, secure):
+    buf = []; add = buf.append
+    if domain  : add("; Domain=%s"  % domain)
+    if path    : add("; Path=%s"    % path)
+    if expires : add("; Expires=%s" % _expires_str(expires))
+    if max_age : add("; Max-Age=%s" % max_age)
+    if httponly: add("; HttpOnly")
+    if secure  : add("; Secure")
+    return "".join(buf)
+
+
+def _expires_str(expires):
+    ## expiresには、文字列かdate型を指定する。
+    ## なおPythonではUTCへの変換が面倒なため、datetime型はエラー
+    if isinstance(expires, str):
+        return expires
+    ## (datetime は date のサブクラスなので、先に調べること)
+    dt = _datetime
+    if isinstance(expires, dt.datetime):
+        raise TypeError("'expires' should be date, not datetime."
+                        " Use 'max_age' keyword arg instead.")
+    elif isinstance(expires, dt.date):
+        return http_datetime(expires)
+    ## timedeltaなら、現在日時からの相対時間とみなす
+    elif isinstance(expires, dt.timedelta):
+        return http_date_clock.after(int(expires.total_seconds()))
+    return expires
+
+
+## quote_plus() は遅いので、エンコード不要な文字だけならそのまま返す
+## (re を import しなくて済むよう、正規表現ではなく str.translate() で調べる)
+def _quote_cookie(s):
+    if not s.translate(_COOKIE_SAFE_TABLE):
+        return s
+    return _urlparse.quote_plus(s)
+
+_COOKIE_SAFE_TABLE = dict.fromkeys(map(ord, "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+                                            "abcdefghijklmnopqrstuvwxyz"
+                                            "0123456789-_.~"))
+
+
+def http_datetime(dt):
+    ## 同じ日時が続けて指定されることが多いので、直前の結果を再利用する
+    global _http_datetime_last
+    last_dt, last_str = _http_datetime_last
+    if dt == last_dt and type(dt) is type(last_dt):
+        return last_str
+    ## strftime()は、ロケールによっては月名や曜日名が英語にならないことがある
+    #return dt.strftime('%a, %d %b %Y %H:%M:%S GMT')
+    ## かわりに、月名と曜日名を自前で設定する
+    ## また strftime() と format() を使うより、% で組み立てるほうが速い
+    w    = dt.weekday()  # Mon: 0, Tue: 1, ...., Sat: 5, Sun: 6
+    wday = _WEEKDAYS[w]
+    mon  = _MONTHS[dt.month]
+    ## なおHTTPでの日時はGMTを使うので、必ずUTCのdatetimeを使うこと
+    H, M, S = ((dt.hour, dt.minute, dt.second) if isinstance(dt, _datetime.datetime)
+               else (0, 0, 0))
+    ## ex: 'Sat, 01 Jan 2000 12:34:56 GMT'
+    s = "%s, %02d %s %04d %02d:%02d:%02d GMT" % (wday, dt.day, mon, dt.year,
+                                                 H, M, S)
+    _http_datetime_last = (dt, s)
+    return s
+
+_http_datetime_last = (None, None)
+
+
+## エポック秒からHTTPの日時文字列を作る (Last-Modified などで使う)
+def http_timestamp(secs):
+    t = time.gmtime(secs)
+    ## ex: 'Sat, 01 Jan 2000 12:34:56 GMT'
+    return "%s, %02d %s %04d %02d:%02d:%02d GMT" % (
+        _WEEKDAYS[t.tm_wday], t.tm_mday, _MONTHS[t.tm_mon], t.tm_year,
+        t.tm_hour, t.tm_min, t.tm_sec)
+
+
+## 現在日時の文字列は1秒に1回しか変わらないので、1秒間はキャッシュする
+class HttpDateClock(object):
+
+    def __init__(self, timer=time.time):
+        self._timer  = timer
+        self._lock   = threading.Lock()
+        self._cached = {}    # ex: {0: (946730096, 'Sat, 01 Jan 2000 12:34:56 GMT')}
+
+    ## 現在日時
+    def now(self):
+        return self.after(0)
+
+    ## 現在日時から offset 秒後 (クッキーの Expires など)
+    def after(self, offset):
+        sec = int(self._timer())
+        t = self._cached.get(offset)
+        if t is not None and t[0] == sec:
+            return t[1]
+        ## 複数のスレッドが同時に作り直さないよう、ロックしてから再確認する
+        with self._lock:
+            t = self._cached.get(offset)
+            if t is None or t[0] != sec:
+                if len(self._cached) > 100:
+                    self._cached.clear()
+                t = (sec, http_timestamp(sec + offset))
+                self._cached[offset] = t
+        return t[1]
+
+http_date_clock = HttpDateClock()
+
+_WEEKDAYS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+_MONTHS   = (None, 'Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+                   'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+
+
+class Session(dict):
+
+    def __init__(self, sid=None, data=None, is_new=False):
+        dict.__init__(self, data or {})
+        self.sid      = sid
+        self.is_new   = is_new
+        self.modified = False
+
+    def __setitem__(self, key, val):
+        dict.__setitem__(self, key, val)
+        self.modified = True
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self.modified = True
+
+    def _modifier(name):
+        meth = getattr(dict, name)
+        def func(self, *args, **kwargs):
+            self.modified = True
+            return meth(self, *args, **kwargs)
+        func.__name__ = name
+        return func
+
+    pop        = _modifier('pop')
+    popitem    = _modifier('popitem')
+    clear      = _modifier('clear')
+    update     = _modifier('update')
+    setdefault = _modifier('setdefault')
+    del _modifier
+
+
+class BaseSessionStore(object):
+
+    def __init__(self, cookie=None):
+        if cookie is None:
+            cookie = CookieTemplate('sess', path='/', httponly=True)
+        self.cookie = cookie
+
+    ## リクエストのクッキーからセッションを取り出す
+    def load(self, req):
+        raise NotImplementedError("%s.load(): not implemented yet." % self.__class__.__name__)
+
+    ## セッションを保存し、必要ならクッキーをレスポンスに追加する
+    def save(self, session, resp):
+        raise NotImplementedError("%s.save(): not implemented yet." % self.__class__.__name__)
+
+
+## セッションの中身をすべてクッキーに入れる。
+## 改ざんを防ぐため HMAC で署名するが、暗号化はしないので秘密の値は入れないこと。
+class CookieSessionStore(BaseSessionStore):
+
+    MAX_COOKIE_SIZE = 4000
+
+    def __init__(self, secret, cookie=None):
+        BaseSessionStore.__init__(self, cookie)
+        if not secret:
+            raise ValueError("CookieSessionStore: secret required.")
+        if isinstance(secret, str):
+            secret = secret.encode('utf-8')
+        self._secret = secret
+
+    def load(self, req):
+        data = self._decode(req.cookies.get(self.cookie.name))
+        if data is None:
+            return Session(None, {}, is_new=True)
+        return Session(None, data)
+
+    def save(self, session, resp):
+        value = self._encode(dict(session))
+        if len(value) > self.MAX_COOKIE_SIZE:
+            raise ValueError("session data too large for cookie (%s bytes)." % len(value))
+        resp.add_cookie(self.cookie, value)
+
+    def _sign(self, payload):
+        return hmac.new(self._secret, payload, hashlib.sha256).hexdigest()
+
+    def _encode(self, data):
+        ## ex: {"x":1} -> 'eyJ4IjoxfQ.5d1f...'
+        binary  = json.dumps(data, separators=(',', ':')).encode('utf-8')
+        payload = base64.urlsafe_b64encode(binary).rstrip(b'=')
+        return "%s.%s" % (payload.decode('ascii'), self._sign(payload))
+
+    def _decode(self, value):
+        if not value or '.' not in value:
+            return None
+        payload, sig = value.rsplit('.', 1)
+        payload = payload.encode('ascii', 'replace')
+        ## 比較には、タイミング攻撃を防ぐため compare_digest() を使う
+        ## (str 同士の比較は ASCII 以外の文字で TypeError になるので、バイト列で比べる)
+        sig = sig.encode('ascii', 'replace')
+        if not hmac.compare_digest(self._sign(payload).encode('ascii'), sig):
+            return None
+        try:
+            binary = base64.urlsafe_b64decode(payload + b'=' * (-len(payload) % 4))
+            data   = json.loads(binary.decode('utf-8'))
+        except ValueError:
+            return None
+        return data if isinstance(data, dict) else None
+
+
+## セッションIDだけをクッキーに入れ、中身はサーバ側に保存する。
+## 最近使ったセッションはプロセス内の LRU キャッシュに残しておく。
+class ServerSessionStore(BaseSessionStore):
+
+    CACHE_SIZE = 1000
+
+    def __init__(self, cookie=None, cache_size=None):
+        BaseSessionStore.__init__(self, cookie)
+        self._cache_size = cache_size or self.CACHE_SIZE
+        self._cache = collections.OrderedDict()
+        self._lock  = threading.Lock()
+
+    def load(self, req):
+        sid  = req.cookies.get(self.cookie.name)
+        data = self._get(sid) if sid else None
+        if data is None:
+            sid = secrets.token_urlsafe(24)
+            return Session(sid, {}, is_new=True)
+        return Session(sid, data)
+
+    def save(self, session, resp):
+        data = dict(session)
+        self._store_data(session.sid, data)
+        self._put(session.sid, data)
+        if session.is_new:
+            resp.add_cookie(self.cookie, session.sid)
+
+    def delete(self, sid):
+        with self._lock:
+            self._cache.pop(sid, None)
+        self._delete_data(sid)
+
+    def _get(self, sid):
+        cache = self._cache
+        with self._lock:
+            data = cache.get(sid)
+            if data is not None:
+                cache.move_to_end(sid)
+                return data
+        data = self._load_data(sid)
+        if data is not None:
+            self._put(sid, data)
+        return data
+
+    def _put(self, sid, data):
+        cache = self._cache
+        with self._lock:
+            cache[sid] = data
+            cache.move_to_end(sid)
+            while len(cache) > self._cache_size:
+                cache.popitem(last=False)
+
+    ## サブクラスで、セッションの中身を読み書きする処理を定義する
+    def _load_data(self, sid):
+        return None
+
+    def _store_data(self, sid, data):
+        pass
+
+    def _delete_data(self, sid):
+        pass
+
+
+## LRU キャッシュだけを使う。プロセスを再起動するとセッションは消える。
+class MemorySessionStore(ServerSessionStore):
+    pass
+
+
+## セッションの中身を SQLite に保存する
+class SqliteSessionStore(ServerSessionStore):
+
+    def __init__(self, dbfile, cookie=None, cache_size=None):
+        ServerSessionStore.__init__(self, cookie, cache_size)
+        import sqlite3
+        self._sqlite3 = sqlite3
+        self._dbfile  = dbfile
+        self._local   = threading.local()   # 接続はスレッドごとに作る
+        self._conn().execute("CREATE TABLE IF NOT EXISTS sessions"
+                             " (sid TEXT PRIMARY KEY, data TEXT, updated_at REAL)")
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._sqlite3.connect(self._dbfile, isolation_level=None)
+            self._local.conn = conn
+        return conn
+
+    def _load_data(self, sid):
+        sql = "SELECT data FROM sessions WHERE sid = ?"
+        row = self._conn().execute(sql, (sid,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _store_data(self, sid, data):
+        sql = "INSERT OR REPLACE INTO sessions (sid, data, updated_at) VALUES (?, ?, ?)"
+        self._conn().execute(sql, (sid, json.dumps(data), time.time()))
+
+    def _delete_data(self, sid):
+        self._conn().execute("DELETE FROM sessions WHERE sid = ?", (sid,))
+
+
+## HTMLエスケープする。特殊文字を含まない文字列はそのまま返す。
+def escape_html(value):
+    s = value if isinstance(value, str) else _to_str(value)
+    if '&' in s: s = s.replace('&', '&amp;')
+    if '<' in s: s = s.replace('<', '&lt;')
+    if '>' in s: s = s.replace('>', '&gt;')
+    if '"' in s: s = s.replace('"', '&quot;')
+    if "'" in s: s = s.replace("'", '&#39;')
+    return s
+
+
+def _to_str(value):
+    return "" if value is None else str(value)
+
+
+## テンプレートの書き方:
+##   ${expr}          -- 式の値をHTMLエスケープして埋め込む
+##   #{expr}          -- 式の値をそのまま埋め込む
+##   <?py stmt ?>     -- Pythonの文 (1行に1つだけ書ける)
+##   <?py #endfor ?>  -- '#end' で始まるコメントでブロックを閉じる
+## ex:
+##   <ul>
+##   <?py for item in items: ?>
+##     <li>${item}</li>
+##   <?py #endfor ?>
+##   </ul>
+class TemplateCompiler(object):
+
+    STMT_REXP = r'^[ \t]*<\?py\s(.*?)\?>[ \t]*(?:\r?\n|\Z)'
+    EXPR_REXP = r'[$#]\{'     # 式の終わりは、括弧の対応を数えて探す
+
+    ## 字下げを戻してから出力する文
+    DEDENT_WORDS = ('else:', 'elif ', 'except', 'finally:')
+
+    def compile(self, string, filename="<string>", generator=False):
+        src = self.convert(string, generator)
+        code = self._compile(src, filename)
+        ## テンプレートの中で代入している変数 (ex: items = sorted(items)) は
+        ## ローカル変数になるので、関数の先頭でコンテキストから値をコピーする
+        local_names = code.co_varnames[code.co_argcount:]
+        if local_names:
+            src = self.convert(string, generator, local_names)
+            code = self._compile(src, filename)
+        return src, code
+
+    def _compile(self, src, filename):
+        code = compile(src, filename, 'exec')
+        ## モジュールのコードから、関数のコードだけを取り出す
+        for const in code.co_consts:
+            if isinstance(const, type(code)) and const.co_name == '__render':
+                return const
+        raise ValueError("%s: failed to compile template." % filename)
+
+    ## テンプレートをPythonのコードに変換する。
+    ## 出力は _extend() にまとめて渡す (generator が真なら yield する)。
+    ## _context の既定値には、Template._func() がコンテキストを設定する。
+    ## ex:
+    ##   def __render(_extend, _context=None):
+    ##       _extend(('<ul>\n', ))
+    ##       for item in items:
+    ##           _extend(('  <li>', _escape(item), '</li>\n', ))
+    ##       _extend(('</ul>\n', ))
+    def convert(self, string, generator=False, local_names=()):
+        if generator:
+            buf = ["def __render(_context=None):\n", "    if 0: yield\n"]
+            self._out = "%syield ''.join((%s, ))\n"
+        else:
+            buf = ["def __render(_extend, _context=None):\n"]
+            self._out = "%s_extend((%s, ))\n"
+        for name in local_names:
+            buf.append("    if %r in _context: %s = _context[%r]\n" % (name, name, name))
+        depth = 1
+        pos = 0
+        for m in re.finditer(self.STMT_REXP, string, re.M):
+            depth = self._add_text(buf, string[pos:m.start()], depth)
+            depth = self._add_stmt(buf, m.group(1).strip(), depth)
+            pos = m.end()
+        depth = self._add_text(buf, string[pos:], depth)
+        if depth != 1:
+            raise SyntaxError("%d block(s) not closed." % (depth - 1))
+        buf.append("    pass\n")
+        return "".join(buf)
+
+    def _add_text(self, buf, text, depth):
+        if not text:
+            return depth
+        items = []
+        pos = 0
+        for start, end, kind, expr in self._find_exprs(text):
+            if start > pos:
+                items.append(repr(text[pos:start]))
+            if kind == '$':
+                items.append("_escape(%s)" % expr)
+            else:
+                items.append("_to_str(%s)" % expr)
+            pos = end
+        if pos < len(text):
+            items.append(repr(text[pos:]))
+        buf.append(self._out % ("    " * depth, ", ".join(items)))
+        return depth
+
+    ## '${...}' と '#{...}' を探す。式の中の '{}' や文字列リテラルも考慮する。
+    ## ex: "${ {'a': 1}['a'] }" -> (0, 19, '$', " {'a': 1}['a'] ")
+    def _find_exprs(self, text):
+        rexp = re.compile(self.EXPR_REXP)
+        n = len(text)
+        pos = 0
+        while True:
+            m = rexp.search(text, pos)
+            if m is None:
+                return
+            i = m.end()
+            depth = 1
+            quote = None
+            while i < n:
+                c = text[i]
+                if quote:
+                    if c == '\\':
+                        i += 1
+                    elif c == quote:
+                        quote = None
+                elif c == '"' or c == "'":
+                    quote = c
+                elif c == '{':
+                    depth += 1
+                elif c == '}':
+                    depth -= 1
+                    if depth == 0:
+                        break
+                i += 1
+            else:
+                raise SyntaxError("%r: '}' not found." % text[m.start():m.start()+20])
+            yield m.start(), i + 1, text[m.start()], text[m.end():i]
+            pos = i + 1
+
+    def _add_stmt(self, buf, stmt, depth):
+        if stmt.startswith('#'):
+            if stmt.startswith('#end'):
+                if depth <= 1:
+                    raise SyntaxError("%r: unexpected end of block." % stmt)
+                depth -= 1
+            return depth
+        if stmt.startswith(self.DEDENT_WORDS):
+            buf.append("%s%s\n" % ("    " * (depth - 1), stmt))
+            return depth
+        buf.append("%s%s\n" % ("    " * depth, stmt))
+        if stmt.endswith(':'):
+            depth += 1
+        return depth
+
+
+class Template(object):
+
+    FLUSH_SIZE = 8 * 1024    # stream() が一度に返す大きさの目安 (文字数)
+
+    def __init__(self, string, filename="<string>"):
+        self.filename = filename
+        self.mtime = None
+        self._string   = string
+        ## 最初に使うときにコンパイルする (import 時に re などを読み込まないように)
+        self._source   = None
+        self._code     = None
+        self._gen_code = None
+
+    def _compile(self):
+        self._source, self._code = TemplateCompiler().compile(self._string, self.filename)
+
+    @property
+    def source(self):
+        if self._source is None:
+            self._compile()
+        return self._source
+
+    ## コンパイル済みのコードから、コンテキストをグローバル変数とする関数を作る
+    ## (exec() と違い、コードを実行し直す必要がない)。
+    ## テンプレートの中で代入される変数のために、引数 _context の既定値にも渡す。
+    def _func(self, code, context, kwargs):
+        g = {'_escape': escape_html, '_to_str': _to_str, '__builtins__': __builtins__}
+        if context:
+            g.update(context)
+        if kwargs:
+            g.update(kwargs)
+        return types.FunctionType(code, g, None, (g,))
+
+    ## 出力をリストに集めて、1つの文字列として返す
+    def render(self, context=None, /, **kwargs):
+        if self._code is None:
+            self._compile()
+        buf = []
+        self._func(self._code, context, kwargs)(buf.extend)
+        return "".join(buf)
+
+    ## 出力を少しずつ返すジェネレータを返す
+    ## (アクションがこれを返せば、WSGIApplication はそのままストリーミングする)
+    def generate(self, context=None, /, **kwargs):
+        if self._gen_code is None:
+            _, self._gen_code = TemplateCompiler().compile(
+                self._string, self.filename, generator=True)
+        return self._func(self._gen_code, context, kwargs)()
+
+    ## UTF-8 のバイト列を少しずつ返すジェネレータを返す。
+    ## 小さな断片ごとに送ると遅いので、flush_size 文字以上たまったらまとめて返す。
+    ## ページの先頭部分は、残りを生成している間にブラウザへ送られる。
+    def stream(self, context=None, flush_size=None, /, **kwargs):
+        return self._stream(self.generate(context, **kwargs),
+                            flush_size or self.FLUSH_SIZE)
+
+    def _stream(self, chunks, flush_size):
+        buf = []; add = buf.append
+        size = 0
+        for chunk in chunks:
+            add(chunk)
+            size += len(chunk)
+            if size >= flush_size:
+                yield "".join(buf).encode('utf-8')
+                del buf[:]
+                size = 0
+        if buf:
+            yield "".join(buf).encode('utf-8')
+
+
+## テンプレートファイルを読み込み、コンパイルしたものをキャッシュする。
+## check_mtime が真なら、ファイルの更新日時が変わったときに読み込み直す
+## (本番環境では False にすれば、stat() を呼ばずに済む)。
+class TemplateEngine(object):
+
+    def __init__(self, template_dir="templates", check_mtime=True,
+                 flush_size=None):
+        self.template_dir = template_dir
+        self.check_mtime  = check_mtime
+        self.flush_size   = flush_size
+        self._cache = {}    # ex: {'templates/index.html': Template}
+
+    def get_template(self, name):
+        filepath = os.path.join(self.template_dir, name)
+        t = self._cache.get(filepath)
+        if t is not None and not self.check_mtime:
+            return t
+        mtime = os.path.getmtime(filepath)
+        if t is not None and t.mtime == mtime:
+            return t
+        with open(filepath, encoding='utf-8') as f:
+            string = f.read()
+        t = Template(string, filepath)
+        t.mtime = mtime
+        self._cache[filepath] = t
+        return t
+
+    def render(self, name, context=None, /, **kwargs):
+        return self.get_template(name).render(context, **kwargs)
+
+    def generate(self, name, context=None, /, **kwargs):
+        return self.get_template(name).generate(context, **kwargs)
+
+    def stream(self, name, context=None, /, **kwargs):
+        return self.get_template(name).stream(context, self.flush_size, **kwargs)
+
+
+class BaseAction(object):
+
+    ## セッションを使う場合は、セッションストアを設定する
+    ## ex: SESSION_STORE = CookieSessionStore(secret="...")
+    SESSION_STORE = None
+
+    ## テンプレートを使う場合は、テンプレートエンジンを設定する
+    ## ex: TEMPLATE_ENGINE = TemplateEngine("templates", check_mtime=False)
+    TEMPLATE_ENGINE = None
+
+    def __init__(self, req, resp):
+        self.req  = req
+        self.resp = resp
+
+    def _template_engine(self):
+        if self.TEMPLATE_ENGINE is None:
+            raise ValueError("%s: TEMPLATE_ENGINE is not set." % self.__class__.__name__)
+        return self.TEMPLATE_ENGINE
+
+    ## テンプレートを使ってHTMLを生成する
+    def render(self, template_name, context=None, /, **kwargs):
+        return self._template_engine().render(template_name, context, **kwargs)
+
+    ## 大きなページ向け。生成しながら、UTF-8 のバイト列として少しずつブラウザに送る。
+    ## (after_action() やセッションの保存は、送り終わる前に実行されることに注意)
+    def render_stream(self, template_name, context=None, /, **kwargs):
+        return self._template_engine().stream(template_name, context, **kwargs)
+
+    ## セッションは、参照されたときに初めて読み込む
+    @property
+    def session(self):
+        if not hasattr(self, '_session'):
+            if self.SESSION_STORE is None:
+                raise ValueError("%s: SESSION_STORE is not set." % self.__class__.__name__)
+            self._session = self.SESSION_STORE.load(self.req)
+        return self._session
+
+    def before_action(self):
+        pass
+
+    def after_action(self, ex):
+        pass
+
+    def invoke_action(self, func, kwargs):
+        content = func(self, **kwargs)
+        timer = self.req.timer
+        if timer: timer.lap('action')
+        return content
+
+    def handle_action(self, func, kwargs):
+        timer = self.req.timer
+        ex = None
+        try:
+            self.before_action()
+            if timer: timer.lap('before_action')
+            content = self.invoke_action(func, kwargs)
+        except Exception as ex_:
+            ex = ex_
+            raise
+        finally:
+            self.after_action(ex)
+            if timer: timer.lap('after_action')
+            if isinstance(ex, HttpException):
+                self._save_session(ex)
+        self._save_session()
+        return content
+
+    ## セッションが変更されたときだけ保存する。
+    ## HttpException (リダイレクトなど) のときは、クッキーを例外に引き継ぐ。
+    def _save_session(self, ex=None):
+        sess = self.__dict__.get('_session')
+        if sess is not None and sess.modified:
+            self.SESSION_STORE.save(sess, self.resp)
+        if ex is not None and self.resp._cookies:
+            ex.cookies = self.resp._cookies
+
+
+class Action(BaseAction):
+
+    def invoke_action(self, func, kwargs):
+        content = BaseAction.invoke_action(self, func, kwargs)
+        if isinstance(content, dict):
+            content = json.dumps(content, ensure_ascii=False)
+            self.resp.content_type = "application/json"
+            timer = self.req.timer
+            if timer: timer.lap('json')
+        return content
+
+
+def on(req_meth, urlpath):
+    localvars = sys._getframe(1).f_locals
+    mapping = localvars.setdefault('__mapping__', [])
+    for upath, funcs in mapping:
+        if upath == urlpath:
+            break
+    else:
+        funcs = {}
+        mapping.append((urlpath, funcs))
+    if req_meth in funcs:
+        raise ValueError("@on(%r, %r): duplicated." % (req_meth, urlpath))
+    def deco(func):
+        funcs[req_meth] = func
+        return func
+    return deco
+
+
+class HelloAction(Action):
+
+    ITEMS = [
+        {"name": "Alice"},
+        {"name": "Bob"},
+        {"name": "Charlie"},
+    ]
+
+    @on('GET', r'.json')
+    def do_index(self):
+        return {
+            "items": self.ITEMS,
+        }
+
+    @on('GET', r'/{name:<\w+>}.json')
+    def do_show(self, name):
+        for x in self.ITEMS:
+            if x['name'] == name:
+                break
+        else:
+            self.resp.status = "404 Not Found"
+            return {"error": "404 Not Found"}
+        msg = "Hello, %s!" % name
+        return {"message": msg}
+
+
+class EnvironAction(Action):
+
+    @on('GET', r'')
+    def do_render(self):
+        environ = self.req.environ
+        buf = []
+        for key in sorted(environ.keys()):
+            if key in os.environ:
+                continue
+            val = environ[key]
+            typ = "(%s)" % type(val).__name__
+            buf.append("%-25s %-7s %r\n" % (key, typ, val))
+        content = "".join(buf)
+        self.resp.content_type = "text/plain;charset=utf-8"
+        return content
+
+
+class FormAction(Action):
+
+    FORM_TEMPLATE = Template(
+        '<p>self.req.method: ${repr(req.method)}</p>\n'
+        '<p>self.req.query: ${repr(req.query)}</p>\n'
+        '<form method="POST" action="/public/form"\n'
+        '      enctype="multipart/form-data">\n'
+        '  Name:<br>\n'
+        '  <input type="text" name="name"><br>\n'
+        '  Comment:<br>\n'
+        '  <textarea name="comment"></textarea><br>\n'
+        '  File:<br>\n'
+        '  <input type="file" name="upfile"><br>\n'
+        '  <input type="submit">\n'
+        '</form>\n')
+
+    RESULT_TEMPLATE = Template(
+        '<p>self.req.method: ${repr(req.method)}</p>\n'
+        '<p>self.req.query: ${repr(req.query)}</p>\n'
+        '<p>self.req.multipart:</p>\n'
+        '<dl>\n'
+        '<?py for name, value in sorted(strs.items()): ?>\n'
+        '  <dt>${name}</dt><dd>${value}</dd>\n'
+        '<?py #endfor ?>\n'
+        '<?py for name, (value, filename) in sorted(files.items()): ?>\n'
+        '  <dt>${name}</dt><dd>${filename} (${len(value)} chars)</dd>\n'
+        '<?py #endfor ?>\n'
+        '</dl>\n'
+        '<p><a href="/public/form">back</p>\n')
+
+    @on('GET', r'')
+    def do_form(self):
+        return self.FORM_TEMPLATE.render(req=self.req)
+
+    @on('POST', r'')
+    def do_post(self):
+        strs, files = self.req.multipart
+        return self.RESULT_TEMPLATE.render(req=self.req, strs=strs, files=files)
+
+
+class SessionAction(Action):
+
+    SESSION_STORE = MemorySessionStore()
+
+    @on('GET', r'')
+    def do_count(self):
+        count = self.session.get('count', 0) + 1
+        self.session['count'] = count
+        return {"count": count}
+
+
+mapping_list = [
+    ['/public', [
+        ('/hello'    , HelloAction),
+        ('/environ'  , EnvironAction),
+        ('/form'     , FormAction),
+        ('/session'  , SessionAction),
+    ]],
+]
+
+
+## 静的ファイルを配信するアクション。サブクラスで STATIC_DIR を設定して使う。
+## ex:
+##   class StaticAction(StaticFilesAction):
+##       STATIC_DIR = os.path.join(os.path.dirname(__file__), 'static')
+##   mapping_list = [ ('/static', StaticAction), ... ]
+class StaticFilesAction(Action):
+
+    STATIC_DIR     = None
+    STAT_CACHE_TTL = 1.0     # stat() の結果をキャッシュする秒数
+    USE_GZIP       = True    # 'foo.css.gz' があれば、'foo.css' のかわりに返す
+
+    @on('GET', r'/{path:<.+>}')
+    def do_get(self, path):
+        return self._serve(path)
+
+    @on('HEAD', r'/{path:<.+>}')
+    def do_head(self, path):
+        return self._serve(path)
+
+    def _serve(self, path):
+        info = self._file_info(path)
+        if info is None:
+            raise HttpException("404 Not Found")
+        filepath, size, etag, last_modified, ctype, gz_size = info
+        env = self.req.environ
+        resp = self.resp
+        resp.content_type = ctype
+        resp.headers['Last-Modified'] = last_modified
+        ## 圧縮済みのファイルがあり、ブラウザが gzip に対応していればそれを返す
+        ## (範囲指定があるときは使わない)
+        use_gz = (gz_size is not None and not env.get('HTTP_RANGE')
+                  and 'gzip' in env.get('HTTP_ACCEPT_ENCODING', ""))
+        if use_gz:
+            etag = etag[:-1] + '-gz"'      # ex: '"5e1f-c"' -> '"5e1f-c-gz"'
+        resp.headers['ETag'] = etag
+        if gz_size is not None:
+            resp.headers['Vary'] = 'Accept-Encoding'
+        ## 更新されていなければ、304 を返す
+        inm = env.get('HTTP_IF_NONE_MATCH')
+        if inm is not None:
+            if inm.strip() == '*' or etag in [ s.strip() for s in inm.split(',') ]:
+                resp.status = "304 Not Modified"
+                return ""
+        elif env.get('HTTP_IF_MODIFIED_SINCE') == last_modified:
+            resp.status = "304 Not Modified"
+            return ""
+        ## 範囲指定があれば、その部分だけを返す
+        resp.headers['Accept-Ranges'] = 'bytes'
+        rng = env.get('HTTP_RANGE')
+        if rng:
+            pair = _parse_range(rng, size)
+            if pair is False:
+                resp.status = "416 Range Not Satisfiable"
+                resp.headers['Content-Range'] = "bytes */%d" % size
+                return ""
+            if pair is not None:
+                start, end = pair
+                resp.status = "206 Partial Content"
+                resp.headers['Content-Range'] = "bytes %d-%d/%d" % (start, end, size)
+                resp.headers['Content-Length'] = str(end - start + 1)
+                return FileContent(self._open(filepath, path), start, end - start + 1)
+        if use_gz:
+            resp.headers['Content-Encoding'] = 'gzip'
+            resp.headers['Content-Length'] = str(gz_size)
+            return FileContent(self._open(filepath + '.gz', path))
+        resp.headers['Content-Length'] = str(size)
+        return FileContent(self._open(filepath, path))
+
+    def _open(self, filepath, path):
+        try:
+            return open(filepath, 'rb')
+        except OSError:
+            ## キャッシュしたあとで削除された (次のリクエストでは stat() し直す)
+            _static_file_cache.pop((self.STATIC_DIR, path), None)
+            raise HttpException("404 Not Found")
+
+    def _file_info(self, path):
+        root = self.STATIC_DIR
+        if not root:
+            raise ValueError("%s.STATIC_DIR is not set." % self.__class__.__name__)
+        key = (root, path)
+        now = time.time()
+        t = _static_file_cache.get(key)
+        if t is not None and now - t[0] < self.STAT_CACHE_TTL:
+            return t[1]
+        info = self._stat_file(root, path)
+        if len(_static_file_cache) > 10000:
+            _static_file_cache.clear()
+        _static_file_cache[key] = (now, info)
+        return info
+
+    def _stat_file(self, root, path):
+        ## '..' や隠しファイルを含むパスは受けつけない
+        if '\0' in path or '\\' in path:
+            return None
+        parts = path.split('/')
+        for x in parts:
+            if not x or x.startswith('.'):
+                return None
+        root = os.path.realpath(root)
+        filepath = os.path.join(root, *parts)
+        ## シンボリックリンクで STATIC_DIR の外を指していないか
+        if not os.path.realpath(filepath).startswith(root + os.sep):
+            return None
+        try:
+            st = os.stat(filepath)
+        except OSError:
+            return None
+        if not os.path.isfile(filepath):
+            return None
+        etag = '"%x-%x"' % (st.st_mtime_ns, st.st_size)
+        last_modified = http_timestamp(int(st.st_mtime))
+        ctype, _ = mimetypes.guess_type(filepath)
+        ctype = ctype or "application/octet-stream"
+        if ctype.startswith('text/'):
+            ctype += ";charset=utf-8"
+        gz_size = None
+        if self.USE_GZIP:
+            try:
+                gz_st = os.stat(filepath + '.gz')
+                if gz_st.st_mtime >= st.st_mtime:   # 古い圧縮ファイルは使わない
+                    gz_size = gz_st.st_size
+            except OSError:
+                pass
+        return (filepath, st.st_size, etag, last_modified, ctype, gz_size)
+
+
+_static_file_cache = {}   # ex: {(root, path): (checked_at, info)}
+
+
+## 'bytes=0-99' のような範囲指定を解析する。範囲は1つだけサポートする。
+## 解析できなければ None (ファイル全体を返す)、範囲外なら False (416 を返す)
+## ('bytes=5-3' のように構文として正しくない指定は、RFC 7233 に従って無視する)
+def _parse_range(rng, size):
+    if not rng.startswith('bytes=') or ',' in rng:
+        return None
+    first, sep, last = rng[6:].strip().partition('-')
+    if not sep:
+        return None
+    try:
+        if not first:                  # ex: 'bytes=-500' (最後の500バイト)
+            n = int(last)
+            if n <= 0:
+                return False
+            start, end = max(0, size - n), size - 1
+        else:
+            start = int(first)
+            if not last:               # ex: 'bytes=500-' (500バイト目から最後まで)
+                end = size - 1
+            elif int(last) < start:    # ex: 'bytes=5-3'
+                return None
+            else:
+                end = min(int(last), size - 1)
+    except ValueError:
+        return None
+    if start >= size:
+        return False
+    return start, end
+
+
+## 集計結果を返すアクション。使う場合はマッピングリストに追加し、
+## WSGIApplication(..., profiler=Profiler(default_metrics)) とすること。
+class MetricsAction(Action):
+
+    METRICS = None    # None なら default_metrics を使う
+
+    @on('GET', r'')
+    def do_metrics(self):
+        metrics = self.METRICS or default_metrics
+        self.resp.content_type = "text/plain; version=0.0.4; charset=utf-8"
+        return metrics.render_prometheus()
+
+
+## マッピングリストには、アクションクラスのかわりにWSGIアプリケーションも指定できる。
+## クラス以外の呼び出し可能なオブジェクトを、WSGIアプリケーションとみなす。
+## ex: ('/legacy', legacy_wsgi_app)
+def _is_wsgi_app(target):
+    return callable(target) and not isinstance(target, type)
+
+
+## 最初に match() が呼ばれたときに、URLパスパターンを正規表現にコンパイルする。
+## コンパイル後は、インスタンス変数の match が正規表現オブジェクトのメソッドになる。
+class _LazyRexp(object):
+
+    def __init__(self, convert, urlpath, source=None):
+        self._convert = convert
+        self._urlpath = urlpath
+        self._source  = source    # 変換済みの正規表現 (キャッシュから読んだとき)
+
+    def source(self):
+        if self._source is None:
+            self._source = self._convert(self._urlpath)
+        return self._source
+
+    def compile(self):
+        rexp = re.compile(self.source())
+        self.pattern = rexp.pattern
+        self.match   = rexp.match
+        return rexp
+
+    def match(self, string):
+        return self.compile().match(string)
+
+    def __getattr__(self, name):   # ex: 'pattern', 'groupindex'
+        return getattr(self.compile(), name)
+
+
+class ActionMapping(object):
+
+    ## cache_file を指定すると、構築したルーティング表をファイルに保存し、
+    ## 次回からはそれを読み込む (マッピングが変わっていれば作り直す)
+    def __init__(self, mapping_list, cache_file=None):
+        self._fixed_dict    = {}
+        self._variable_list = []
+        self._mounts        = {}    # ex: {'/legacy': legacy_wsgi_app}
+        self._collect_mounts(mapping_list)
+        entries = None
+        if cache_file:
+            key = self._fingerprint(mapping_list)
+            entries = self._load_cache(cache_file, key)
+        if entries is None:
+            entries = self._build(mapping_list, [])
+            if cache_file:
+                self._save_cache(cache_file, key, entries)
+        for t in entries:
+            full_urlpath, klass, funcs, rexp, prefix = t
+            if prefix is None:
+                self._fixed_dict[full_urlpath] = (klass, funcs, full_urlpath)
+            else:
+                self._variable_list.append(t)
+
+    ## 正規表現をまとめてコンパイルする。
+    ## prefork する前に呼べば、各ワーカーでのコンパイルが不要になる。
+    def compile_all(self):
+        for _, _, _, rexp, _ in self._variable_list:
+            if isinstance(rexp, _LazyRexp):
+                rexp.compile()
+
+    def _build(self, mapping_list, new_list, base_urlpath=""):
+        for urlpath, target in mapping_list:
+            current_urlpath = base_urlpath + urlpath
+            if isinstance(target, list):
+                child_list = target
+                self._build(child_list, new_list, current_urlpath)
+            elif _is_wsgi_app(target):
+                pass    # _collect_mounts() で登録済み
+            else:
+                klass = target
+                self._validate_action_class(klass)
+                for upath, funcs in getattr(klass, '__mapping__'):
+                    full_urlpath = current_urlpath + upath
+                    ## 正規表現は、最初に使うときにコンパイルする
+                    rexp = _LazyRexp(self._convert_urlpath, full_urlpath)
+                    i = full_urlpath.find('{')
+                    prefix = (full_urlpath[:i] if i >= 0 else None)
+                    #
+                    t = (full_urlpath, klass, funcs, rexp, prefix)
+                    new_list.append(t)
+        return new_list
+
+    ## WSGIアプリケーションは、ルーティング表には入れずに別の辞書で管理する
+    ## (キャッシュファイルを使う場合も、毎回この処理を行う)
+    def _collect_mounts(self, mapping_list, base_urlpath=""):
+        for urlpath, target in mapping_list:
+            current_urlpath = base_urlpath + urlpath
+            if isinstance(target, list):
+                self._collect_mounts(target, current_urlpath)
+            elif _is_wsgi_app(target):
+                prefix = current_urlpath.rstrip('/')   # ex: '/legacy/' -> '/legacy'
+                if '{' in prefix:
+                    raise ValueError("%r: cannot mount WSGI application"
+                                     " on URL path pattern." % current_urlpath)
+                if prefix in self._mounts:
+                    raise ValueError("%r: duplicated mount point." % current_urlpath)
+                self._mounts[prefix] = target
+
+    @property
+    def has_mounts(self):
+        return bool(self._mounts)
+
+    ## リクエストパスの先頭部分がマウントポイントと一致するか、'/' ごとに短くしながら調べる
+    ## ex: '/legacy/foo/bar' -> '/legacy/foo' -> '/legacy' -> ''
+    def lookup_mount(self, req_path, host=None):   # host は使わない
+        mounts = self._mounts
+        s = req_path
+        while True:
+            app = mounts.get(s)
+            if app is not None:
+                return app, s
+            if not s:
+                return None, None
+            s = s[:s.rfind('/')]
+
+    CACHE_VERSION = 1
+
+    ## マッピングリストの内容と、アクションクラスが定義されたファイルの
+    ## 更新日時からハッシュ値を計算する (各ルートの中身までは調べない)
+    def _fingerprint(self, mapping_list):
+        items = [self.CACHE_VERSION]
+        files = set([__file__])
+        def walk(mapping_list, base_urlpath):
+            for urlpath, target in mapping_list:
+                if isinstance(target, list):
+                    walk(target, base_urlpath + urlpath)
+                elif _is_wsgi_app(target):
+                    items.append((base_urlpath + urlpath, 'mount'))
+                else:
+                    klass = target
+                    items.append((base_urlpath + urlpath,
+                                  klass.__module__, klass.__qualname__))
+                    mod = sys.modules.get(klass.__module__)
+                    filename = getattr(mod, '__file__', None)
+                    if filename:
+                        files.add(filename)
+        walk(mapping_list, "")
+        for filename in sorted(files):
+            st = os.stat(filename)
+            items.append((filename, st.st_mtime_ns, st.st_size))
+        return hashlib.sha1(repr(items).encode('utf-8')).hexdigest()
+
+    ## キャッシュファイルには、クラスや関数そのものではなく import 用の名前を保存する
+    ## ex: ('/api/foo/{id}', 'app.foo', 'FooAction', {'GET': 'do_show'},
+    ##      '^/api/foo/(?P<id>[^/]+)$', '/api/foo/')
+    def _save_cache(self, cache_file, key, entries):
+        rows = []
+        for full_urlpath, klass, funcs, rexp, prefix in entries:
+            names = {}
+            for meth, func in funcs.items():
+                if getattr(klass, func.__name__, None) is not func:
+                    return False     # クラス属性から取り出せない関数はキャッシュできない
+                names[meth] = func.__name__
+            if '<locals>' in klass.__qualname__:
+                return False
+            rows.append((full_urlpath, klass.__module__, klass.__qualname__, names,
+                         rexp.source(), prefix))
+        import marshal
+        tmpfile = "%s.%s.tmp" % (cache_file, os.getpid())
+        ## 書き込めない場所 (読み込み専用など) なら、キャッシュせずにそのまま続ける
+        try:
+            with open(tmpfile, 'wb') as f:
+                marshal.dump((self.CACHE_VERSION, key, rows), f)
+            os.replace(tmpfile, cache_file)   # 書き込み途中のファイルを読まれないように
+        except OSError:
+            try:
+                os.unlink(tmpfile)
+            except OSError:
+                pass
+            return False
+        return True
+
+    def _load_cache(self, cache_file, key):
+        import marshal
+        try:
+            with open(cache_file, 'rb') as f:
+                version, cached_key, rows = marshal.load(f)
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+        if version != self.CACHE_VERSION or cached_key != key:
+            return None
+        entries = []
+        for full_urlpath, modname, qualname, names, source, prefix in rows:
+            try:
+                __import__(modname)
+                klass = sys.modules[modname]
+                for attr in qualname.split('.'):
+                    klass = getattr(klass, attr)
+                funcs = { meth: getattr(klass, name) for meth, name in names.items() }
+            except (ImportError, KeyError, AttributeError):
+                return None
+            rexp = _LazyRexp(self._convert_urlpath, full_urlpath, source)
+            entries.append((full_urlpath, klass, funcs, rexp, prefix))
+        return entries
+
+    def _validate_action_class(self, klass):
+        if not isinstance(klass, type):
+            raise TypeError("%r: expected action class." % (klass,))
+        if not issubclass(klass, BaseAction):
+            raise TypeError("%r: should be a subclass of BaseAction." % klass)
+        if not hasattr(klass, '__mapping__'):
+            raise ValueError("%r: no mapping data." % klass)
+
+    def _convert_urlpath(self, urlpath):   # ex: '/api/foo/{id}.json'
+        def _re_escape(string):
+            return re.escape(string).replace(r'\/', '/')
+        #
+        param_rexps = {'str': r'[^/]+', 'int': r'\d+'}
+        buf = ['^']; add = buf.append
+        pos = 0
+        for m in re.finditer(r'(.*?)\{(\w+)(:\w*)?(<[^>]*>)?\}', urlpath):
+            pos = m.end(0)                   # ex: 13
+            string, pname, ptype, prexp = m.groups()  # ex: ('/api/foo/', 'id')
+            if ptype: ptype = ptype[1:]      # ex: ':int' -> 'int'
+            if prexp: prexp = prexp[1:-1]    # ex: '<\d+>' -> '\d+'
+            #
+            if not ptype:
+                ptype = 'str'
+            if ptype not in param_rexps:
+                raise ValueError("%r: contains unknown data type %r." \
+                                     % (urlpath, ptype))
+            if not prexp:
+                prexp = param_rexps[ptype]
+            #
+            add(_re_escape(string))
+            add('(?P<%s>%s)' % (pname, prexp))  # ex: '(?P<id>[^/]+)'
+        remained = urlpath[pos:]  # ex: '.json'
+        add(_re_escape(remained))
+        add('$')
+        return "".join(buf)   # ex: '^/api/foo/(?P<id>[^/]+)\\.json$'
+
+    def lookup(self, req_path, host=None):   # host は使わない
+        t = self._fixed_dict.get(req_path)
+        if t:
+            klass, funcs, urlpath = t
+            kwargs = {}
+            return klass, funcs, kwargs, urlpath
+        for urlpath, klass, funcs, rexp, prefix in self._variable_list:
+            if not req_path.startswith(prefix):
+                continue
+            m = rexp.match(req_path)
+            if m:
+                kwargs = m.groupdict()  # ex: {"id": 123}
+                ## 計測などで使うため、URLパスパターンも返す
+                # ex: return FooAction, {"GET": do_show}, {"id": 123}, '/foo/{id}'
+                return klass, funcs, kwargs, urlpath
+        return None, None, None, None
+
+
+## ホスト名ごとに ActionMapping を持つ。
+## ex:
+##   host_mapping = HostMapping([
+##       ('www.example.com', www_mapping_list),
+##       ('*.example.com',   user_mapping_list),   # ワイルドカード (サブドメイン)
+##       ('*',               default_mapping_list), # それ以外すべて
+##   ])
+##   wsgi_app = WSGIApplication(host_mapping)
+class HostMapping(object):
+
+    CACHE_SIZE = 1000
+
+    def __init__(self, host_mapping_list):
+        self._exact     = {}     # ex: {'www.example.com': ActionMapping}
+        self._wildcards = {}     # ex: {'example.com': ActionMapping}
+        self._default   = None
+        for host, mapping in host_mapping_list:
+            if not isinstance(mapping, ActionMapping):
+                mapping = ActionMapping(mapping)
+            host = host.lower()
+            if host == '*':
+                self._default = mapping
+                continue
+            elif host.startswith('*.'):
+                d, key = self._wildcards, host[2:]
+            else:
+                d, key = self._exact, host
+            if key in d:
+                raise ValueError("%r: duplicated host." % host)
+            d[key] = mapping
+        ## 一度調べたホスト名は、辞書を1回引くだけで見つかるようにする
+        self._cache = dict(self._exact)
+
+    def mapping_for(self, host):
+        mapping = self._cache.get(host)
+        if mapping is not None:
+            return mapping
+        ## ex: 'a.b.example.com' -> 'b.example.com' -> 'example.com' -> 'com'
+        s = host
+        while mapping is None:
+            i = s.find('.')
+            if i < 0:
+                break
+            s = s[i+1:]
+            mapping = self._wildcards.get(s)
+        if mapping is None:
+            mapping = self._default
+            if mapping is None:
+                return None
+        ## Hostヘッダはクライアントが自由に指定できるので、キャッシュの大きさを制限する
+        if len(self._cache) >= len(self._exact) + self.CACHE_SIZE:
+            self._cache = dict(self._exact)
+        self._cache[host] = mapping
+        return mapping
+
+    def lookup(self, req_path, host=None):
+        mapping = self.mapping_for(host or "")
+        if mapping is None:
+            return None, None, None, None
+        return mapping.lookup(req_path)
+
+    @property
+    def has_mounts(self):
+        mappings = list(self._exact.values()) + list(self._wildcards.values())
+        if self._default is not None:
+            mappings.append(self._default)
+        return any(m.has_mounts for m in mappings)
+
+    def lookup_mount(self, req_path, host=None):
+        mapping = self.mapping_for(host or "")
+        if mapping is None:
+            return None, None
+        return mapping.lookup_mount(req_path)
+
+    def compile_all(self):
+        mappings = list(self._exact.values()) + list(self._wildcards.values())
+        if self._default is not None:
+            mappings.append(self._default)
+        for mapping in mappings:
+            mapping.compile_all()
+
+
+## リクエストごとに作られ、処理の段階ごとの経過時間を記録する
+class PhaseTimer(object):
+
+    def __init__(self, method, clock=time.perf_counter):
+        self.method  = method
+        self.route   = None    # ex: '/api/foo/{id}'
+        self.status  = None
+        self.timings = []      # ex: [('lookup', 0.000012), ('action', 0.0031)]
+        self.headers = []      # レスポンスヘッダに追加するもの
+        self._clock  = clock
+        self._start  = self._last = clock()
+
+    ## 前回から今回までの経過時間を、段階名をつけて記録する
+    def lap(self, phase):
+        now = self._clock()
+        self.timings.append((phase, now - self._last))
+        self._last = now
+
+    @property
+    def total(self):
+        return self._last - self._start
+
+
+class Profiler(object):
+
+    def __init__(self, *sinks):
+        self.sinks = sinks
+
+    def start(self, environ):
+        return PhaseTimer(environ['REQUEST_METHOD'])
+
+    def finish(self, timer):
+        for sink in self.sinks:
+            sink.record(timer)
+
+
+## 計測結果をメモリ上に集計する。
+## 経過時間は、2のべき乗(マイクロ秒)ごとのバケツで数える。
+class HistogramSink(object):
+
+    def __init__(self):
+        self._lock  = threading.Lock()
+        self._stats = {}    # ex: {('/foo/{id}', 'action'): [count, total, max, {bucket: n}]}
+
+    def record(self, timer):
+        route = timer.route or "(not found)"
+        items = timer.timings + [('total', timer.total)]
+        with self._lock:
+            stats = self._stats
+            for phase, sec in items:
+                key = (route, phase)
+                st = stats.get(key)
+                if st is None:
+                    st = stats[key] = [0, 0.0, 0.0, {}]
+                st[0] += 1
+                st[1] += sec
+                if sec > st[2]:
+                    st[2] = sec
+                bucket = int(sec * 1000000).bit_length()   # ex: 100usec -> 7
+                st[3][bucket] = st[3].get(bucket, 0) + 1
+
+    def stats(self):
+        with self._lock:
+            return { k: (v[0], v[1], v[2], dict(v[3])) for k, v in self._stats.items() }
+
+    def report(self):
+        buf = []
+        for (route, phase), (count, total, max_, _) in sorted(self.stats().items()):
+            buf.append("%-30s %-14s count=%-6d avg=%.3fms max=%.3fms\n"
+                       % (route, phase, count, total / count * 1000, max_ * 1000))
+        return "".join(buf)
+
+
+## 計測結果をログに出力する
+class LogSink(object):
+
+    def __init__(self, logger=None):
+        if logger is None:
+            import logging
+            logger = logging.getLogger(__name__)
+        self._logger = logger
+
+    def record(self, timer):
+        s = " ".join("%s=%.3fms" % (phase, sec * 1000) for phase, sec in timer.timings)
+        self._logger.info("%s %s %s total=%.3fms %s", timer.method, timer.route,
+                          timer.status, timer.total * 1000, s)
+
+
+## 計測結果を Server-Timing ヘッダとしてブラウザに返す
+class ServerTimingSink(object):
+
+    def record(self, timer):
+        s = ", ".join("%s;dur=%.3f" % (phase, sec * 1000) for phase, sec in timer.timings)
+        timer.headers.append(('Server-Timing', s))
+
+
+## HDR Histogram 風のヒストグラム。
+## 値(マイクロ秒)を2のべき乗ごとに区切り、さらにそれを SUB_COUNT 個に区切って数える。
+## 相対誤差は 1/SUB_COUNT 以下になる。
+class LatencyHistogram(object):
+
+    SUB_BITS  = 3
+    SUB_COUNT = 1 << SUB_BITS   # 8
+    SIZE      = 256             # 約 2^31 マイクロ秒 (約35分) まで
+
+    def __init__(self):
+        self.count  = 0
+        self.sum    = 0.0           # seconds
+        self.counts = [0] * self.SIZE
+
+    @classmethod
+    def index(cls, usec):
+        if usec < 2 * cls.SUB_COUNT:
+            return usec
+        e = usec.bit_length() - (cls.SUB_BITS + 1)
+        i = (e + 1) * cls.SUB_COUNT + (usec >> e) - cls.SUB_COUNT
+        return i if i < cls.SIZE else cls.SIZE - 1
+
+    @classmethod
+    def upper_bound(cls, index):   # マイクロ秒
+        if index < 2 * cls.SUB_COUNT:
+            return index + 1
+        e = index // cls.SUB_COUNT - 1
+        m = index % cls.SUB_COUNT + cls.SUB_COUNT
+        return (m + 1) << e
+
+    def add(self, sec):
+        self.count += 1
+        self.sum   += sec
+        self.counts[self.index(int(sec * 1000000))] += 1
+
+    def merge(self, other):
+        self.count += other.count
+        self.sum   += other.sum
+        counts = self.counts
+        for i, n in enumerate(other.counts):
+            if n:
+                counts[i] += n
+
+    def percentile(self, p):   # ex: p=99.0 -> seconds
+        if not self.count:
+            return 0.0
+        threshold = self.count * p / 100.0
+        n = 0
+        for i, c in enumerate(self.counts):
+            n += c
+            if n >= threshold:
+                return self.upper_bound(i) / 1000000.0
+        return self.upper_bound(self.SIZE - 1) / 1000000.0
+
+
+## スレッドごとの集計データを持つ (スレッドの終了を weakref で検知するため)
+class _ThreadTable(object):
+
+    def __init__(self):
+        self.table = {}
+
+
+## (URLパスパターン, リクエストメソッド, ステータス) ごとにリクエスト数とレイテンシを集計する。
+## 集計データはスレッドごとに持つのでロックは不要で、読み出すときにまとめる。
+class MetricsSink(object):
+
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self._local   = threading.local()
+        self._tables  = {}    # 実行中の全スレッドの集計データ (ex: {id(table): table})
+        self._retired = {}    # 終了したスレッドの集計データをまとめたもの
+        self._lock    = threading.Lock()   # 登録時と終了時にだけ使う
+
+    def _table(self):
+        try:
+            return self._local.holder.table
+        except AttributeError:
+            import weakref
+            holder = self._local.holder = _ThreadTable()
+            table = holder.table
+            with self._lock:
+                self._tables[id(table)] = table
+            ## スレッドが終了すると holder が解放されるので、そのときに
+            ## 集計データを _retired へまとめる (接続ごとにスレッドを作るサーバ対策)
+            weakref.finalize(holder, self._retire, table)
+            return table
+
+    def _retire(self, table):
+        with self._lock:
+            self._tables.pop(id(table), None)
+            self._merge_into(self._retired, table)
+
+    def record(self, timer):
+        status = timer.status or ""
+        key = (timer.route or "(not found)", timer.method, status[:1] + "xx")  # ex: '2xx'
+        table = self._table()
+        hist = table.get(key)
+        if hist is None:
+            hist = table[key] = LatencyHistogram()
+        hist.add(timer.total)
+
+    def collect(self):
+        merged = {}
+        ## 終了したスレッドの分は _retire() が書き換えるので、ロックしたまままとめる
+        with self._lock:
+            tables = list(self._tables.values())
+            self._merge_into(merged, self._retired)
+        for table in tables:
+            self._merge_into(merged, table.copy())
+        return merged   # ex: {('/foo/{id}', 'GET', '2xx'): LatencyHistogram}
+
+    @staticmethod
+    def _merge_into(merged, table):
+        for key, hist in table.items():
+            m = merged.get(key)
+            if m is None:
+                m = merged[key] = LatencyHistogram()
+            m.merge(hist)
+
+    ## Prometheus のテキスト形式で出力する
+    def render_prometheus(self):
+        buf = []; add = buf.append
+        merged = sorted(self.collect().items())
+        add("# TYPE http_requests_total counter\n")
+        for key, hist in merged:
+            add("http_requests_total{%s} %d\n" % (_prom_labels(key), hist.count))
+        add("# TYPE http_request_duration_seconds histogram\n")
+        upper = LatencyHistogram.upper_bound
+        for key, hist in merged:
+            labels = _prom_labels(key)
+            i = 0; n = 0
+            for le in self.BUCKETS:
+                limit = le * 1000000
+                while i < hist.SIZE and upper(i) <= limit:
+                    n += hist.counts[i]
+                    i += 1
+                add('http_request_duration_seconds_bucket{%s,le="%s"} %d\n' % (labels, le, n))
+            add('http_request_duration_seconds_bucket{%s,le="+Inf"} %d\n' % (labels, hist.count))
+            add("http_request_duration_seconds_sum{%s} %.6f\n" % (labels, hist.sum))
+            add("http_request_duration_seconds_count{%s} %d\n" % (labels, hist.count))
+        return "".join(buf)
+
+
+def _prom_labels(key):
+    route, method, status = key
+    esc = lambda s: s.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return 'route="%s",method="%s",status="%s"' % (esc(route), esc(method), status)
+
+
+default_metrics = MetricsSink()
+
+
+## 一部のリクエストだけをプロファイラの下で実行し、結果をURLパスパターンごとに集める。
+## 対象になるのは、rate の割合でランダムに選ばれたリクエストと、
+## header で指定したヘッダの値が token と一致するリクエスト。
+## 誰でもプロファイルを有効にできないよう、header を使うときは token が必須。
+##   ex: RequestSampler(header='HTTP_X_PROFILE', token=os.environ['PROFILE_TOKEN'])
+##   mode='cprofile' : cProfile で計測する。結果は pstats()/report() で取り出す。
+##   mode='sampling' : 別スレッドから interval 秒ごとにスタックを採取する。
+##                     結果は collapsed() でフレームグラフ用の形式で取り出す。
+class RequestSampler(object):
+
+    def __init__(self, rate=0.0, header=None, token=None, mode='cprofile',
+                 interval=0.005):
+        if mode not in ('cprofile', 'sampling'):
+            raise ValueError("%r: unknown profiling mode." % (mode,))
+        if header and not token:
+            raise ValueError("%r: secret token required to enable profiling by header." % (header,))
+        self.rate     = rate
+        self.header   = header
+        self._token   = token.encode('utf-8') if token else None
+        self.mode     = mode
+        self.interval = interval
+        self._lock    = threading.Lock()
+        self._stats   = {}    # ex: {'/foo/{id}': pstats.Stats}
+        self._stacks  = {}    # ex: {'/foo/{id}': {'main;foo;bar': 12}}
+        self._active  = {}    # ex: {thread_id: '/foo/{id}'}
+        self._thread  = None
+        self._wakeup  = threading.Event()
+        ## cProfile は同時に1つしか動かせないので、使用中ならプロファイルしない
+        self._cprofile_lock = threading.Lock()
+
+    def should_sample(self, environ):
+        if self.header:
+            value = environ.get(self.header)
+            if value and hmac.compare_digest(value.encode('utf-8'), self._token):
+                return True
+        return self.rate > 0 and random.random() < self.rate
+
+    def run(self, route, func, *args):
+        route = route or "(not found)"
+        if self.mode == 'cprofile':
+            return self._run_cprofile(route, func, args)
+        else:
+            return self._run_sampling(route, func, args)
+
+    def _run_cprofile(self, route, func, args):
+        if not self._cprofile_lock.acquire(blocking=False):
+            return func(*args)
+        try:
+            import cProfile
+            prof = cProfile.Profile()
+            try:
+                return prof.runcall(func, *args)
+            finally:
+                self._add_stats(route, prof)
+        finally:
+            self._cprofile_lock.release()
+
+    def _add_stats(self, route, prof):
+        import pstats
+        with self._lock:
+            st = self._stats.get(route)
+            if st is None:
+                self._stats[route] = pstats.Stats(prof)
+            else:
+                st.add(prof)
+
+    def _run_sampling(self, route, func, args):
+        tid = threading.get_ident()
+        with self._lock:
+            self._active[tid] = route
+            if self._thread is None:
+                t = threading.Thread(target=self._sampling_loop, daemon=True)
+                t.start()
+                self._thread = t
+        self._wakeup.set()
+        try:
+            return func(*args)
+        finally:
+            with self._lock:
+                self._active.pop(tid, None)
+
+    def _sampling_loop(self):
+        while True:
+            self._wakeup.wait()
+            with self._lock:
+                active = dict(self._active)
+                if not active:
+                    self._wakeup.clear()
+                    continue
+            frames = sys._current_frames()
+            for tid, route in active.items():
+                frame = frames.get(tid)
+                if frame is not None:
+                    self._add_stack(route, frame)
+            del frames
+            time.sleep(self.interval)
+
+    def _add_stack(self, route, frame):
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append("%s (%s)" % (code.co_name, os.path.basename(code.co_filename)))
+            frame = frame.f_back
+        names.reverse()
+        key = ";".join(names)    # ex: 'main (app.py);foo (app.py);bar (app.py)'
+        with self._lock:
+            d = self._stacks.setdefault(route, {})
+            d[key] = d.get(key, 0) + 1
+
+    def routes(self):
+        with self._lock:
+            return sorted(set(self._stats) | set(self._stacks))
+
+    ## cProfile の結果を pstats.Stats オブジェクトとして返す
+    ## (ファイルに保存するなら、.dump_stats(filename) を使う)
+    def pstats(self, route):
+        with self._lock:
+            return self._stats.get(route)
+
+    def report(self, route, sort='cumulative', limit=30):
+        import io
+        st = self.pstats(route)
+        if st is None:
+            return ""
+        out = io.StringIO()
+        st.stream = out
+        st.sort_stats(sort).print_stats(limit)
+        return out.getvalue()
+
+    ## フレームグラフ (flamegraph.pl など) 用の形式で返す
+    ## ex: 'main (app.py);foo (app.py);bar (app.py) 12\n'
+    def collapsed(self, route):
+        with self._lock:
+            d = dict(self._stacks.get(route) or {})
+        return "".join("%s %d\n" % (k, n) for k, n in sorted(d.items()))
+
+
+## アクションは、文字列のほかにバイト列やファイルも返せる
+##   str         -> UTF-8 でエンコードする
+##   bytes       -> そのまま返す
+##   FileContent -> wsgi.file_wrapper があればそれを使う (sendfile() が使われることがある)
+##   ファイル     -> FileContent と同じ
+##   それ以外     -> str か bytes を返すイテレータとみなす
+def _make_body(content, environ):
+    if isinstance(content, str):
+        return [content.encode('utf-8')]
+    if isinstance(content, bytes):
+        return [content]
+    if hasattr(content, 'read'):
+        content = FileContent(content)
+    if isinstance(content, FileContent):
+        return content.wsgi_iterable(environ)
+    return _encode_iter(content)
+
+
+def _encode_iter(iterable):
+    try:
+        for chunk in iterable:
+            yield chunk.encode('utf-8') if isinstance(chunk, str) else chunk
+    finally:
+        close = getattr(iterable, 'close', None)
+        if close is not None:
+            close()
+
+
+## ファイルの全体または一部 (Range ヘッダ用) を表す
+class FileContent(object):
+
+    BLOCK_SIZE = 64 * 1024
+
+    def __init__(self, file, start=0, length=None):
+        self.file   = file
+        self.start  = start
+        self.length = length    # None ならファイルの最後まで
+
+    def close(self):
+        self.file.close()
+
+    def wsgi_iterable(self, environ):
+        f = self.file
+        if self.start:
+            f.seek(self.start)
+        ## wsgi.file_wrapper はファイルの最後まで送るので、一部だけなら使わない
+        wrapper = environ.get('wsgi.file_wrapper')
+        if wrapper is not None and self.length is None:
+            return wrapper(f, self.BLOCK_SIZE)
+        return self._iter_blocks()
+
+    def _iter_blocks(self):
+        f = self.file
+        size = self.BLOCK_SIZE
+        remained = self.length
+        try:
+            while remained is None or remained > 0:
+                n = size if remained is None else min(size, remained)
+                data = f.read(n)
+                if not data:
+                    break
+                if remained is not None:
+                    remained -= len(data)
+                yield data
+        finally:
+            f.close()
+
+
+class WSGIApplication(object):
+
+    def __init__(self, mapping_list, auto_redirect=True, profiler=None,
+                 sampler=None):
+        if isinstance(mapping_list, (ActionMapping, HostMapping)):
+            self._mapping = mapping_list
+        else:
+            self._mapping = ActionMapping(mapping_list)
+        ## ホスト名を調べるのは、HostMapping を使うときだけ
+        self._by_host = isinstance(self._mapping, HostMapping)
+        self._has_mounts = self._mapping.has_mounts
+        self._auto_redirect = auto_redirect
+        self._profiler = profiler
+        self._sampler  = sampler
+
+    def lookup(self, req_path, host=None):
+        return self._mapping.lookup(req_path, host)
+
+    def __call__(self, environ, start_response):
+        ## マウントしたアプリケーションは、Request を作らずにそのまま呼び出す
+        if self._has_mounts:
+            app = self._lookup_mount(environ)
+            if app is not None:
+                return app(environ, start_response)
+        ## 選ばれたリクエストだけ、プロファイラの下で実行する
+        sampler = self._sampler
+        if sampler is not None and sampler.should_sample(environ):
+            host = _normalize_host(environ) if self._by_host else None
+            _, _, _, route = self.lookup(environ['PATH_INFO'], host)
+            return sampler.run(route, self._call, environ, start_response)
+        return self._call(environ, start_response)
+
+    ## マウントポイントを SCRIPT_NAME に移す。
+    ## environ はリクエストごとに作られるので、コピーせずに直接書き換える。
+    ## ex: SCRIPT_NAME='', PATH_INFO='/legacy/foo'
+    ##     -> SCRIPT_NAME='/legacy', PATH_INFO='/foo'
+    def _lookup_mount(self, environ):
+        req_path = environ['PATH_INFO']
+        host = _normalize_host(environ) if self._by_host else None
+        app, prefix = self._mapping.lookup_mount(req_path, host)
+        if app is None:
+            return None
+        environ['SCRIPT_NAME'] = environ.get('SCRIPT_NAME', "") + prefix
+        environ['PATH_INFO']   = req_path[len(prefix):]
+        return app
+
+    def _call(self, environ, start_response):
+        ## 計測しないときは、余計な処理をいっさいしない
+        if self._profiler is not None:
+            return self._call_with_profiler(environ, start_response)
+        try:
+            status, header_list, content = self._handle_request(environ)
+        except HttpException as ex:
+            status, header_list, content = self._handle_http_exception(ex)
+        body = _make_body(content, environ)
+        start_response(status, header_list)
+        return body
+
+    def _call_with_profiler(self, environ, start_response):
+        timer = self._profiler.start(environ)
+        try:
+            status, header_list, content = self._handle_request(environ, timer)
+        except HttpException as ex:
+            status, header_list, content = self._handle_http_exception(ex)
+        body = _make_body(content, environ)
+        timer.lap('encode')
+        timer.status = status
+        self._profiler.finish(timer)
+        if timer.headers:
+            header_list.extend(timer.headers)
+        start_response(status, header_list)
+        return body
+
+    def _handle_request(self, environ, timer=None):
+        req  = Request(environ)
+        resp = Response()
+        if timer: timer.lap('request')
+        #
+        req_meth = req.method
+        req_path = req.path
+        host     = req.host if self._by_host else None
+        klass, funcs, kwargs, route = self.lookup(req_path, host)
+        if timer:
+            timer.route = route
+            timer.lap('lookup')
+            req.timer = timer
+        #
+        if klass is None:
+            self._try_auto_redirect(req)
+            raise HttpException("404 Not Found")
+        if req_meth not in funcs:
+            raise HttpException("405 Method Not Allowed")
+        #
+        func    = funcs[req_meth]
+        action  = klass(req, resp)
+        content = action.handle_action(func, kwargs)
+        status  = resp.status
+        if req_meth == 'HEAD':
+            if hasattr(content, 'close'):
+                content.close()
+            content = ""
+        #
+        header_list = resp.header_list()  # ex: [('Content-Type': 'text/html')]
+        if timer: timer.lap('response')
+        return status, header_list, content
+
+    def _handle_http_exception(self, ex):
+        content = ex.content or "<h2>%s</h2>" % ex.status
+        headers = {"Content-Type": "text/html;charset=utf-8",
+                   "Date": http_date_clock.now()}
+        if ex.headers:
+            headers.update(ex.headers)
+        header_list = list(headers.items())  # ex: {'X': 'Y'} -> [('X', 'Y')]
+        if ex.cookies:
+            header_list.extend( ('Set-Cookie', s) for s in ex.cookies )
+        return ex.status, header_list, content
+
+    def _try_auto_redirect(self, req):
+        if not self._auto_redirect:
+            return
+        if not req.method in ('GET', 'HEAD'):
+            return
+        s = req.path
+        rpath = (s[:-1] if s.endswith('/') else s+'/')
+        host  = req.host if self._by_host else None
+        klass, _, _, _ = self.lookup(rpath, host)
+        if klass is None:
+            return
+        qs = req.query_string
+        location = "%s?%s" % (rpath, qs) if qs else rpath
+        raise HttpException("301 Moved Permanently", location,
+                            {'Location': location})
+
+
+wsgi_app = WSGIApplication(mapping_list)
+
+
+if __name__ == "__main__":
+    from wsgiref.simple_server import make_server
+    wsgi_server = make_server('localhost', 7000, wsgi_app)
+    wsgi_server.serve_forever()
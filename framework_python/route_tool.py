@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+
+##
+## ルーティング表を表示し、到達できないルートや重なっているルートを調べる
+##
+## usage: python route_tool.py [module:attr ...]
+##   ex: python route_tool.py fw47:mapping_list
+##       python route_tool.py myapp:wsgi_app     # WSGIApplication も指定できる
+##
+## ActionMapping は宣言した順番に正規表現を試し、最初に一致したルートを使う。
+## そのため、'/{name}' を '/{id:int}' より前に書くと後者には決して到達しない。
+## このツールは各ルートのサンプルパスを作り、それより前のルートに横取りされないか、
+## また一致するまでに何回の前方一致チェックと正規表現マッチが必要かを調べる。
+## マウントしたWSGIアプリケーション (fw34 以降) はルートより先に調べられるので、
+## その下にあるルートも到達できないものとして報告する。
+## 終了ステータスは、到達できないルートがあれば 1、なければ 0 (読み込めなければ 2)。
+## 固定パスと可変パスを分けて管理する fw20 以降のフレームワークに対応する。
+## (一部だけ重なっているルートは、具体的なものを先に書いた意図的な順番のことが多いので、
+##  表示するだけにする)
+##
+
+import sys
+import re
+import itertools
+from timeit import timeit
+
+
+## パラメータの値の候補。パラメータの正規表現に一致するものだけを使う。
+SAMPLE_VALUES = ["123", "abc", "a-b_c", "2024-01-01", "x.y", "a/b"]
+
+MAX_SAMPLES = 16
+
+PARAM_REXPS = {'str': r'[^/]+', 'int': r'\d+'}
+
+
+def load(spec):
+    modname, _, attr = spec.partition(':')
+    __import__(modname)
+    return getattr(sys.modules[modname], attr or 'mapping_list')
+
+
+## アクションクラスが継承している BaseAction から、フレームワークのモジュールを探す
+## (バージョンの違うフレームワークを使っていても動くように)
+def framework_of(mapping_list):
+    for _, target in mapping_list:
+        if isinstance(target, list):
+            mod = framework_of(target)
+            if mod:
+                return mod
+        elif isinstance(target, type):
+            for klass in target.__mro__:
+                if klass.__name__ == 'BaseAction':
+                    return sys.modules[klass.__module__]
+    return None
+
+
+## ex: [('', ActionMapping), ...] または [('www.example.com', ActionMapping), ...]
+def mappings_of(obj):
+    if hasattr(obj, '_routing'):          # WSGIApplication (fw47 以降)
+        obj = obj._routing[0]
+    elif hasattr(obj, '_mapping'):        # WSGIApplication
+        obj = obj._mapping
+    if hasattr(obj, '_exact'):            # HostMapping
+        pairs = list(obj._exact.items())
+        pairs += [("*." + k, v) for k, v in obj._wildcards.items()]
+        if obj._default is not None:
+            pairs.append(("*", obj._default))
+        return [(host, m, None) for host, m in pairs]
+    if hasattr(obj, '_variable_list'):    # ActionMapping
+        return [("", obj, None)]
+    fw = framework_of(obj)
+    if fw is None:
+        raise ValueError("no action class found in mapping list.")
+    mapping = fw.ActionMapping(obj)
+    if not hasattr(mapping, '_variable_list'):
+        raise ValueError("%s: not supported (requires fw20 or later)." % fw.__name__)
+    return [("", mapping, obj)]
+
+
+## ルートの一覧を、ルーティングで試される順番に返す。
+## 固定パスは辞書で引かれるので、同じパスが複数あれば後のものが勝つ。
+def routes_of(mapping, mapping_list):
+    if mapping_list is not None:
+        entries = mapping._build(mapping_list, [])
+    else:
+        ## fw28 より前は (klass, funcs)、それ以降は (klass, funcs, urlpath)
+        entries = [(upath, t[0], t[1], None, None)
+                   for upath, t in mapping._fixed_dict.items()]
+        entries += mapping._variable_list
+    fixed, variable = [], []
+    for upath, klass, funcs, rexp, prefix in entries:
+        if prefix is None:
+            fixed.append((upath, klass, funcs))
+        else:
+            variable.append((upath, klass, funcs, rexp, prefix))
+    return fixed, variable
+
+
+## マウントしたWSGIアプリケーション (fw34 以降)。 ex: {'/legacy': legacy_wsgi_app}
+def mounts_of(mapping):
+    return getattr(mapping, '_mounts', None) or {}
+
+
+## コンパイル済みの正規表現 (古いバージョンでは re.Pattern、新しいバージョンでは _LazyRexp)
+def pattern_of(rexp):
+    return rexp.pattern
+
+
+## URLパスパターンから、それに一致するリクエストパスを作る
+## ex: '/api/{id:int}.json' -> ['/api/123.json']
+def sample_paths(urlpath, rexp):
+    params = re.findall(r'\{(\w+)(?::(\w*))?(?:<([^>]*)>)?\}', urlpath)
+    choices = []
+    for pname, ptype, prexp in params:
+        prexp = prexp or PARAM_REXPS.get(ptype or 'str', PARAM_REXPS['str'])
+        vals = [v for v in SAMPLE_VALUES if re.fullmatch(prexp, v)]
+        if not vals:
+            return []
+        choices.append(vals)
+    paths = []
+    for combo in itertools.product(*choices):
+        vals = iter(combo)
+        path = re.sub(r'\{\w+(?::\w*)?(?:<[^>]*>)?\}', lambda m: next(vals), urlpath)
+        if rexp.match(path):
+            paths.append(path)
+            if len(paths) >= MAX_SAMPLES:
+                break
+    return paths
+
+
+## 問題のリストを返す。 ex: [('error', "shadowed: ..."), ('note', "overlap: ...")]
+def analyze(fixed, variable, mounts={}):
+    problems = []
+    ## マウントポイントの下にあるルート (マウントが先に調べられる)
+    def mounted(path):
+        for prefix in mounts:
+            if path == prefix or path.startswith(prefix + "/"):
+                return prefix
+        return None
+    for upath, klass, funcs in fixed:
+        prefix = mounted(upath)
+        if prefix is not None:
+            problems.append(('error', "shadowed: %s is unreachable; mounted application at %s"
+                             % (upath, prefix)))
+    ## 固定パスの重複 (後に書いたものが前のものを上書きする)
+    seen = {}
+    for upath, klass, funcs in fixed:
+        if upath in seen:
+            problems.append(('error', "duplicated: %s (%s) is overridden by %s"
+                            % (upath, seen[upath].__name__, klass.__name__)))
+        seen[upath] = klass
+    ## 可変パスの重なり
+    results = []
+    for j, (upath, klass, funcs, rexp, prefix) in enumerate(variable):
+        samples = sample_paths(upath, rexp)
+        stolen = {}        # ex: {'/{name}': 3}
+        for path in samples:
+            prefix_ = mounted(path)
+            if prefix_ is not None:
+                stolen[prefix_ + " (mount)"] = stolen.get(prefix_ + " (mount)", 0) + 1
+        samples_ = [p for p in samples if mounted(p) is None]
+        prefix_checks = j + 1
+        regex_matches = 0
+        for path in samples_:
+            n = 0
+            for upath_, _, _, rexp_, prefix_ in variable[:j]:
+                if not path.startswith(prefix_):
+                    continue
+                n += 1
+                if rexp_.match(path):
+                    stolen[upath_] = stolen.get(upath_, 0) + 1
+                    break
+            regex_matches = max(regex_matches, n + 1)
+        if samples and sum(stolen.values()) == len(samples):
+            problems.append(('error', "shadowed: %s is unreachable; requests go to %s"
+                             % (upath, ", ".join(stolen))))
+        elif stolen:
+            problems.append(('note', "overlap: %s (%d/%d samples) are routed to %s"
+                             % (upath, sum(stolen.values()), len(samples), ", ".join(stolen))))
+        results.append((upath, klass, funcs, rexp, prefix, samples,
+                        prefix_checks, regex_matches))
+    return results, problems
+
+
+def lookup_usec(mapping, path, number=2000):
+    sec = timeit(lambda: mapping.lookup(path), number=number)
+    return sec / number * 1000000
+
+
+def report(host, mapping, fixed, variable, out=sys.stdout):
+    mounts = mounts_of(mapping)
+    results, problems = analyze(fixed, variable, mounts)
+    w = out.write
+    w("## host: %s\n" % host if host else "## routes\n")
+    for prefix, app in sorted(mounts.items()):
+        w("mount: %-28s %r (checked before routes)\n" % (prefix, app))
+    w("%d fixed (dict lookup), %d variable (tried in order)\n\n" % (len(fixed), len(variable)))
+    w("%-4s %-28s %-14s %-18s %6s %5s %7s\n"
+      % ("#", "urlpath", "methods", "action", "checks", "regex", "usec"))
+    for upath, klass, funcs in fixed:
+        usec = lookup_usec(mapping, upath)
+        w("%-4s %-28s %-14s %-18s %6s %5s %7.3f\n"
+          % ("-", upath, ",".join(funcs), klass.__name__, 0, 0, usec))
+    for i, t in enumerate(results, 1):
+        upath, klass, funcs, rexp, prefix, samples, nchecks, nregex = t
+        usec = lookup_usec(mapping, samples[0]) if samples else 0.0
+        w("%-4d %-28s %-14s %-18s %6d %5d %7.3f\n"
+          % (i, upath, ",".join(funcs), klass.__name__, nchecks, nregex, usec))
+        w("     prefix=%r regex=%s\n" % (prefix, pattern_of(rexp)))
+    ## 一致しないパスは、前方一致するすべてのルートの正規表現を試したあとで 404 になる
+    if variable:
+        w("\nnot found: %d prefix checks, up to %d regex matches\n"
+          % (len(variable), len(variable)))
+    if problems:
+        w("\n")
+        for level, msg in problems:
+            w("%s %s\n" % ("***" if level == 'error' else "---", msg))
+    w("\n")
+    return [msg for level, msg in problems if level == 'error']
+
+
+def main(specs):
+    found = False
+    for spec in specs:
+        try:
+            mappings = mappings_of(load(spec))
+        except ValueError as ex:
+            sys.stderr.write("%s: %s\n" % (spec, ex))
+            return 2
+        for host, mapping, mapping_list in mappings:
+            fixed, variable = routes_of(mapping, mapping_list)
+            if report(host, mapping, fixed, variable):
+                found = True
+    return 1 if found else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:] or ["fw47:mapping_list"]))